@@ -2,22 +2,44 @@ from dotenv import load_dotenv
 load_dotenv()
 
 import os
+import re
 import hmac
 import hashlib
 import logging
+import queue
+import threading
+import atexit
+import time
 # FIX: Added 'timezone' to imports for date math
-from datetime import datetime, timedelta, timezone
-from functools import wraps
-from typing import Optional, Dict, Any
+from datetime import datetime, timezone
+from functools import wraps, partial, lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Dict, Any, Tuple
 import asyncio
+from collections import OrderedDict
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes
+from telegram.ext import AIORateLimiter, Application, CommandHandler, CallbackQueryHandler, ContextTypes
 from telegram.error import TelegramError
+from telegram.request import HTTPXRequest
 import httpx
 from supabase import create_client, Client
-import qrcode
+import segno
+import msgpack
+import orjson
+from cachetools import TTLCache, LRUCache
 from io import BytesIO
+from types import MappingProxyType
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+try:
+    import uvloop
+except ImportError:  # not available on Windows
+    uvloop = None
 
 # Logging with UTF-8 encoding
 logging.basicConfig(
@@ -41,6 +63,41 @@ BTCPAY_API_KEY = os.getenv('BTCPAY_API_KEY')
 BTCPAY_STORE_ID = os.getenv('BTCPAY_STORE_ID')
 BTCPAY_WEBHOOK_SECRET = os.getenv('BTCPAY_WEBHOOK_SECRET')
 REDIS_URL = os.getenv('REDIS_URL', None)
+BOT_USERNAME = os.getenv('BOT_USERNAME', 'your_bot')
+
+# BTCPay endpoint and headers are fixed for the process lifetime
+# (strip any '/stores/...' suffix to avoid duplicating the path)
+BTCPAY_INVOICE_URL = (
+    f"{BTCPAY_URL.rstrip('/').split('/stores/')[0]}/api/v1/stores/{BTCPAY_STORE_ID}/invoices"
+    if BTCPAY_URL else None
+)
+BTCPAY_HEADERS = MappingProxyType({
+    'Authorization': f'token {BTCPAY_API_KEY}',
+    'Content-Type': 'application/json'
+})
+BOT_REDIRECT_URL = f'https://t.me/{BOT_USERNAME}'
+
+# Telegram webhook mode (optional): set TELEGRAM_WEBHOOK_URL to the public
+# HTTPS base URL that forwards to TELEGRAM_WEBHOOK_PORT; otherwise long-polling.
+# Needs a host that can expose a second port (not Render, which only routes $PORT)
+TELEGRAM_WEBHOOK_URL = os.getenv('TELEGRAM_WEBHOOK_URL')
+TELEGRAM_WEBHOOK_PORT = int(os.getenv('TELEGRAM_WEBHOOK_PORT', '8443'))
+TELEGRAM_WEBHOOK_SECRET = os.getenv('TELEGRAM_WEBHOOK_SECRET')
+
+# Telegram's secret_token only allows A-Z, a-z, 0-9, _ and - (1-256 chars);
+# setWebhook rejects anything else, so fall back to polling instead of failing
+_TELEGRAM_SECRET_RE = re.compile(r'[A-Za-z0-9_-]{1,256}')
+if TELEGRAM_WEBHOOK_URL and not (
+    TELEGRAM_WEBHOOK_SECRET and _TELEGRAM_SECRET_RE.fullmatch(TELEGRAM_WEBHOOK_SECRET)
+):
+    logger.error(
+        "TELEGRAM_WEBHOOK_SECRET must be 1-256 characters of A-Z, a-z, 0-9, '_' or '-' "
+        "(e.g. python -c 'import secrets; print(secrets.token_urlsafe(32))') - using long-polling"
+    )
+    TELEGRAM_WEBHOOK_URL = None
+
+# Webhook HMAC key, encoded once
+_WEBHOOK_KEY_BYTES = BTCPAY_WEBHOOK_SECRET.encode() if BTCPAY_WEBHOOK_SECRET else b''
 
 # STRICT PRICING: Force crash if variables are missing
 try:
@@ -70,10 +127,25 @@ TOTAL_SUBSCRIPTION_PRICE = calculate_total_price()
 # Security settings
 MAX_INVOICE_AGE_MINUTES = 15
 RATE_LIMIT_COMMANDS = 10
+RATE_LIMIT_WINDOW = 60
+RATE_LIMIT_WINDOW_MS = RATE_LIMIT_WINDOW * 1000
 ALLOWED_CURRENCIES = ['USD', 'EUR']
 MIN_SUBSCRIPTION_PRICE = 1.0
 MAX_SUBSCRIPTION_PRICE = 10000.0
 
+# Subscription cache: writes invalidate entries (pub/sub), so the TTL can be long
+SUBSCRIPTION_CACHE_TTL = 3600
+SUBSCRIPTION_INVALIDATE_CHANNEL = 'sub_invalidate'
+LOCAL_CACHE_SIZE = 10000
+LOCAL_CACHE_TTL = 30
+# "No active subscription" is cached too, briefly (writes still invalidate it)
+NO_SUBSCRIPTION_CACHE_TTL = 120
+# Pending payment rows, kept until BTCPay has had ample time to settle the invoice
+PAYMENT_CACHE_TTL = 86400
+
+# Explicit column lists (avoid streaming unused columns from PostgREST)
+SUBSCRIPTION_COLUMNS = 'id,user_id,status,plan_type,amount_paid,start_date,end_date'
+
 # ==========================================
 # INITIALIZATION
 # ==========================================
@@ -88,24 +160,81 @@ except Exception as e:
     logger.critical(f"Failed to initialize Supabase: {e}")
     supabase = None
 
-# Initialize Redis cache if available
+# Initialize Redis cache if available. One connection pool is shared by the
+# cache, the pub/sub listener and main.py's rate limiter; callers wait for a
+# free connection instead of failing when it is exhausted.
+REDIS_POOL_SIZE = 64
+redis_pool = None
 cache = None
-if REDIS_URL:
+if REDIS_URL and redis is None:
+    logger.warning("Redis not installed. Install with: pip install redis")
+elif REDIS_URL:
     try:
-        import redis
-        cache = redis.from_url(REDIS_URL, decode_responses=True)
+        redis_pool = redis.BlockingConnectionPool.from_url(
+            REDIS_URL, max_connections=REDIS_POOL_SIZE, timeout=5
+        )
+        cache = redis.Redis(connection_pool=redis_pool)
         logger.info("Redis cache initialized")
-    except ImportError:
-        logger.warning("Redis not installed. Install with: pip install redis")
     except Exception as e:
         logger.warning(f"Redis connection failed: {e}")
 
-# HTTP client with connection pooling
+# Sliding window: at most RATE_LIMIT_COMMANDS hits in any RATE_LIMIT_WINDOW
+# span, tracked as a sorted set of hit timestamps (one round-trip per check).
+# ARGV: now_ms, window_ms, limit, member. Returns 1 if allowed.
+RATE_LIMIT_LUA = """
+local now = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], 0, now - window)
+if redis.call('ZCARD', KEYS[1]) < tonumber(ARGV[3]) then
+    redis.call('ZADD', KEYS[1], now, ARGV[4])
+    redis.call('PEXPIRE', KEYS[1], window)
+    return 1
+end
+return 0
+"""
+rate_limit_script = cache.register_script(RATE_LIMIT_LUA) if cache else None
+
+# Worker pool for the blocking supabase client (keeps handlers off the event loop)
+DB_POOL_SIZE = 20
+db_executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix='db')
+
+# Activity logs are queued and written in batches by a background thread
+ACTIVITY_BATCH_SIZE = 100
+ACTIVITY_FLUSH_INTERVAL = 1.0
+activity_queue = queue.Queue(maxsize=10000)
+activity_flush_event = threading.Event()
+
+# QR rendering (segno raster + zlib) takes a few ms, so it runs on its own
+# small thread pool off the event loop. Not a process pool: forking this
+# process (flusher/db threads, Redis and httpx pools) risks inherited locks
+QR_CACHE_SIZE = 256
+qr_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='qr')
+
+# Telegram file_ids of uploaded QR PNGs, keyed by content hash
+QR_FILE_ID_TTL = 86400
+
+# HTTP/2 client with connection pooling (transport retries cover connect errors)
 http_client = httpx.AsyncClient(
-    timeout=30.0,
-    limits=httpx.Limits(max_keepalive_connections=5, max_connections=10)
+    timeout=httpx.Timeout(connect=5.0, read=15.0, write=5.0, pool=5.0),
+    transport=httpx.AsyncHTTPTransport(
+        http2=True,
+        retries=2,
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=50, keepalive_expiry=60)
+    )
 )
 
+# Updates handled concurrently (handlers are async and DB work runs in db_executor;
+# invoice flows are deduplicated per user, menu edits are idempotent)
+CONCURRENT_UPDATES = 256
+
+# Connection pool for PTB's own Bot API requests, sized for concurrent handlers
+TELEGRAM_POOL_SIZE = 64
+TELEGRAM_POOL_TIMEOUT = 20.0
+GET_UPDATES_POOL_TIMEOUT = 30.0
+
+# Stay under Telegram's ~30 msg/s bot-wide ceiling; excess calls queue instead of 429ing
+TELEGRAM_MAX_RATE = 28
+
 
 # ==========================================
 # SECURITY UTILITIES
@@ -114,6 +243,9 @@ def sanitize_string(value: str, max_length: int = 255) -> str:
     """Sanitize string input to prevent injection attacks"""
     if not isinstance(value, str):
         return ""
+    # Fast path: str.isprintable() scans in C, and almost every input passes
+    if value.isprintable():
+        return value[:max_length].strip()
     sanitized = ''.join(char for char in value if char.isprintable() or char.isspace())
     return sanitized[:max_length].strip()
 
@@ -143,16 +275,16 @@ def verify_btcpay_webhook(payload: bytes, signature: str) -> bool:
         return False
     
     try:
-        expected_sig = hmac.new(
-            BTCPAY_WEBHOOK_SECRET.encode(),
-            payload,
-            hashlib.sha256
-        ).hexdigest()
-        
-        if signature.startswith('sha256='):
-            signature = signature[7:]
-        
-        return hmac.compare_digest(expected_sig, signature)
+        # Malformed signatures are rejected before hashing the body
+        received_sig = bytes.fromhex(signature.removeprefix('sha256='))
+    except ValueError:
+        logger.warning("Webhook signature is not valid hex")
+        return False
+    
+    try:
+        # One-shot OpenSSL HMAC with the pre-encoded key, compared as raw bytes
+        expected_sig = hmac.digest(_WEBHOOK_KEY_BYTES, payload, 'sha256')
+        return hmac.compare_digest(expected_sig, received_sig)
     except Exception as e:
         logger.error(f"Webhook verification error: {e}")
         return False
@@ -164,19 +296,13 @@ def rate_limit_check(user_id: int, action: str = "command") -> bool:
         return True
     
     try:
-        key = f"ratelimit:{action}:{user_id}"
-        count = cache.get(key)
-        
-        if count is None:
-            cache.setex(key, 60, 1)
-            return True
-        
-        count = int(count)
-        if count >= RATE_LIMIT_COMMANDS:
-            return False
-        
-        cache.incr(key)
-        return True
+        key = f"ratelimit:window:{action}:{user_id}"
+        now_ns = time.time_ns()
+        allowed = rate_limit_script(
+            keys=[key],
+            args=[now_ns // 1_000_000, RATE_LIMIT_WINDOW_MS, RATE_LIMIT_COMMANDS, now_ns]
+        )
+        return allowed == 1
     except Exception as e:
         logger.error(f"Rate limit check error: {e}")
         return True
@@ -185,8 +311,73 @@ def rate_limit_check(user_id: int, action: str = "command") -> bool:
 # ==========================================
 # CACHE UTILITIES
 # ==========================================
+_packb = partial(msgpack.packb, use_bin_type=True)
+_unpackb = partial(msgpack.unpackb, raw=False)
+
+# Process-local L1 in front of Redis (shared by handler, DB and Flask threads)
+_local_subscriptions = TTLCache(maxsize=LOCAL_CACHE_SIZE, ttl=LOCAL_CACHE_TTL)
+_local_subscriptions_lock = threading.Lock()
+
+
+# Bumped on every local eviction (i.e. every invalidation): a lookup that saw
+# an older value must not write its possibly stale "no subscription" result
+_invalidation_seq = 0
+
+
+def _evict_local_subscription(telegram_id: int):
+    """Drop a subscription from the process-local cache"""
+    global _invalidation_seq
+    with _local_subscriptions_lock:
+        _local_subscriptions.pop(telegram_id, None)
+        _invalidation_seq += 1
+
+
+@lru_cache(maxsize=LOCAL_CACHE_SIZE)
+def parse_end_date(value: str) -> datetime:
+    """Parse a subscription end_date once per distinct value (naive = UTC)"""
+    end_date = datetime.fromisoformat(value)
+    if end_date.tzinfo is None:
+        end_date = end_date.replace(tzinfo=timezone.utc)
+    return end_date
+
+
+@lru_cache(maxsize=LOCAL_CACHE_SIZE)
+def format_end_date(value: str) -> str:
+    """Human-readable expiry date for a subscription end_date"""
+    return parse_end_date(value).strftime('%B %d, %Y')
+
+
+def days_left(subscription: Dict, now: Optional[datetime] = None) -> int:
+    """Whole days until a subscription expires"""
+    return (parse_end_date(subscription['end_date']) - (now or datetime.now(timezone.utc))).days
+
+
+# Users known to have (had) an active subscription. Once loaded, lookups for
+# anyone else skip Redis and the DB; a stale extra id only costs a normal lookup.
+_paying_users = set()
+_paying_users_loaded = False
+
+
+def mark_paying_user(telegram_id: int):
+    """Remember that a user has an active subscription"""
+    _paying_users.add(telegram_id)
+
+
+def may_have_subscription(telegram_id: int) -> bool:
+    """False only when the user is known to have never subscribed"""
+    return not _paying_users_loaded or telegram_id in _paying_users
+
+
 def get_cached_subscription(telegram_id: int) -> Optional[Dict]:
-    """Get subscription from cache"""
+    """Get subscription from cache (process-local first, then Redis)
+    
+    An empty dict means the user is cached as having no active subscription.
+    """
+    with _local_subscriptions_lock:
+        subscription = _local_subscriptions.get(telegram_id)
+    if subscription is not None:
+        return subscription
+    
     if not cache:
         return None
     
@@ -194,77 +385,225 @@ def get_cached_subscription(telegram_id: int) -> Optional[Dict]:
         key = f"sub:{telegram_id}"
         data = cache.get(key)
         if data:
-            import json
-            return json.loads(data)
+            subscription = _unpackb(data)
+            with _local_subscriptions_lock:
+                _local_subscriptions[telegram_id] = subscription
+            return subscription
     except Exception as e:
         logger.error(f"Cache read error: {e}")
     return None
 
 
-def set_cached_subscription(telegram_id: int, subscription: Dict, ttl: int = 60):
-    """Cache subscription data for 60 seconds (balance between speed and freshness)"""
-    if not cache or not subscription:
+def set_cached_subscription(telegram_id: int, subscription: Dict, ttl: int = SUBSCRIPTION_CACHE_TTL):
+    """Cache subscription data until invalidated (never past its end_date)"""
+    if not subscription:
+        return
+    
+    mark_paying_user(telegram_id)
+    
+    with _local_subscriptions_lock:
+        _local_subscriptions[telegram_id] = subscription
+    
+    if not cache:
         return
     
     try:
-        import json
+        end_date = parse_end_date(subscription['end_date'])
+        ttl = min(ttl, int((end_date - datetime.now(timezone.utc)).total_seconds()))
+        if ttl <= 0:
+            return
+        
         key = f"sub:{telegram_id}"
-        cache.setex(key, ttl, json.dumps(subscription))
+        cache.setex(key, ttl, _packb(subscription))
+    except Exception as e:
+        logger.error(f"Cache write error: {e}")
+
+
+# Per-user invalidation counter in Redis (shared by every process)
+SUBSCRIPTION_VERSION_TTL = 3600
+
+# Write the negative entry only if no invalidation ran since the lookup began
+# (version unchanged) and nothing was cached meanwhile (NX)
+NO_SUBSCRIPTION_LUA = """
+local current = redis.call('GET', KEYS[2]) or ''
+if current ~= ARGV[1] then
+    return 0
+end
+if redis.call('SET', KEYS[1], ARGV[2], 'NX', 'EX', ARGV[3]) then
+    return 1
+end
+return 0
+"""
+no_subscription_script = cache.register_script(NO_SUBSCRIPTION_LUA) if cache else None
+
+
+def subscription_lookup_version(telegram_id: int) -> Tuple[int, bytes]:
+    """Invalidation versions to take before a DB lookup (see cache_no_subscription)"""
+    remote = b''
+    if cache:
+        try:
+            remote = cache.get(f"subver:{telegram_id}") or b''
+        except Exception as e:
+            logger.error(f"Cache read error: {e}")
+    return _invalidation_seq, remote
+
+
+def cache_no_subscription(telegram_id: int, version: Tuple[int, bytes]):
+    """Cache that the user has no active subscription, unless it was invalidated since `version`"""
+    local_seq, remote_version = version
+    with _local_subscriptions_lock:
+        if _invalidation_seq != local_seq:
+            return
+        _local_subscriptions.setdefault(telegram_id, {})
+    
+    if not cache:
+        return
+    
+    try:
+        no_subscription_script(
+            keys=[f"sub:{telegram_id}", f"subver:{telegram_id}"],
+            args=[remote_version, _packb({}), NO_SUBSCRIPTION_CACHE_TTL]
+        )
     except Exception as e:
         logger.error(f"Cache write error: {e}")
 
 
 def invalidate_subscription_cache(telegram_id: int):
-    """Remove subscription from cache"""
+    """Remove subscription from cache and notify other processes"""
+    _evict_local_subscription(telegram_id)
+    
     if not cache:
         return
     
+    try:
+        version_key = f"subver:{telegram_id}"
+        pipe = cache.pipeline(transaction=False)
+        pipe.incr(version_key)
+        pipe.expire(version_key, SUBSCRIPTION_VERSION_TTL)
+        pipe.delete(f"sub:{telegram_id}")
+        pipe.publish(SUBSCRIPTION_INVALIDATE_CHANNEL, telegram_id)
+        pipe.execute()
+    except Exception as e:
+        logger.error(f"Cache invalidation error: {e}")
+
+
+def _on_subscription_invalidated(message):
+    """Pub/sub handler: drop the cached subscription for the published telegram_id"""
+    try:
+        telegram_id = int(message['data'])
+    except (TypeError, ValueError):
+        return
+    
+    # Invalidations are published on subscription writes
+    mark_paying_user(telegram_id)
+    _evict_local_subscription(telegram_id)
+    
     try:
         cache.delete(f"sub:{telegram_id}")
     except Exception as e:
         logger.error(f"Cache invalidation error: {e}")
 
 
+def _on_pubsub_error(error, pubsub, thread):
+    """Keep the invalidation listener alive across Redis hiccups"""
+    logger.warning(f"Subscription invalidation listener error: {error}")
+    time.sleep(1)
+
+
+def start_invalidation_listener():
+    """Subscribe to subscription invalidations published by any process"""
+    if not cache:
+        return None
+    
+    try:
+        pubsub = cache.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{SUBSCRIPTION_INVALIDATE_CHANNEL: _on_subscription_invalidated})
+        return pubsub.run_in_thread(sleep_time=1.0, daemon=True, exception_handler=_on_pubsub_error)
+    except Exception as e:
+        logger.warning(f"Subscription invalidation listener not started: {e}")
+        return None
+
+
+invalidation_listener = start_invalidation_listener()
+
+
+def get_cached_payment(invoice_id: str) -> Optional[Dict]:
+    """Payment row for a BTCPay invoice, if cached"""
+    if not cache:
+        return None
+    try:
+        data = cache.get(f"payment:{invoice_id}")
+        return _unpackb(data) if data else None
+    except Exception as e:
+        logger.error(f"Payment cache read error: {e}")
+        return None
+
+
+def set_cached_payment(invoice_id: str, payment: Dict):
+    """Cache a payment row for the lifetime of its invoice's webhooks"""
+    if not cache:
+        return
+    try:
+        cache.setex(f"payment:{invoice_id}", PAYMENT_CACHE_TTL, _packb(payment))
+    except Exception as e:
+        logger.error(f"Payment cache write error: {e}")
+
+
+def invalidate_payment_cache(invoice_id: str):
+    """Drop a cached payment row after it changes"""
+    if not cache:
+        return
+    try:
+        cache.delete(f"payment:{invoice_id}")
+    except Exception as e:
+        logger.error(f"Payment cache delete error: {e}")
+
+
 # ==========================================
 # DATABASE FUNCTIONS
 # ==========================================
+async def run_db(func, *args, **kwargs):
+    """Run a blocking database helper on the DB worker pool"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, partial(func, *args, **kwargs))
+
+
 def get_or_create_user(telegram_id: int, username: str = None, first_name: str = None) -> Optional[Dict]:
-    """Get user from database or create if doesn't exist"""
+    """Get user from database or create if doesn't exist (single upsert round-trip)"""
+    user, _ = get_user_with_active_subscription(telegram_id, username, first_name)
+    return user
+
+
+def get_user_with_active_subscription(telegram_id: int, username: str = None,
+                                      first_name: str = None) -> Tuple[Optional[Dict], Optional[Dict]]:
+    """Upsert user and fetch their active subscription in a single round-trip"""
     if not validate_telegram_id(telegram_id):
         logger.error(f"Invalid telegram_id: {telegram_id}")
-        return None
+        return None, None
     
+    version = subscription_lookup_version(telegram_id)
     try:
-        username = sanitize_string(username, 32) if username else None
-        first_name = sanitize_string(first_name, 64) if first_name else None
+        # One RPC replaces SELECT user + INSERT user + SELECT subscription
+        result = supabase.rpc('get_user_with_active_sub', {
+            'p_tid': telegram_id,
+            'p_username': sanitize_string(username, 32) if username else None,
+            'p_first': sanitize_string(first_name, 64) if first_name else None
+        }).execute()
         
-        result = supabase.table('users')\
-            .select('*')\
-            .eq('telegram_id', telegram_id)\
-            .execute()
+        data = result.data or {}
+        user = data.get('user')
+        subscription = data.get('subscription')
         
-        if result.data:
-            return result.data[0]
-        
-        # FIX: Use UTC now
-        new_user = {
-            'telegram_id': telegram_id,
-            'username': username,
-            'first_name': first_name,
-            'created_at': datetime.now(timezone.utc).isoformat()
-        }
-        
-        result = supabase.table('users').insert(new_user).execute()
-        
-        if result.data:
-            logger.info(f"New user created: {telegram_id}")
-            return result.data[0]
+        if subscription:
+            set_cached_subscription(telegram_id, subscription)
+        elif user:
+            cache_no_subscription(telegram_id, version)
         
-        return None
+        return user, subscription
         
     except Exception as e:
-        logger.error(f"Error in get_or_create_user: {e}", exc_info=True)
-        return None
+        logger.error(f"Error in get_user_with_active_subscription: {e}", exc_info=True)
+        return None, None
 
 
 def get_active_subscription(telegram_id: int, use_cache: bool = True) -> Optional[Dict]:
@@ -273,14 +612,18 @@ def get_active_subscription(telegram_id: int, use_cache: bool = True) -> Optiona
         return None
     
     if use_cache:
+        if not may_have_subscription(telegram_id):
+            return None
+        
         cached = get_cached_subscription(telegram_id)
-        if cached:
-            return cached
+        if cached is not None:
+            return cached or None
     
+    version = subscription_lookup_version(telegram_id)
     try:
         # FIX: Use UTC now for comparison
         result = supabase.table('subscriptions')\
-            .select('*')\
+            .select(SUBSCRIPTION_COLUMNS)\
             .eq('user_id', telegram_id)\
             .eq('status', 'active')\
             .gte('end_date', datetime.now(timezone.utc).isoformat())\
@@ -292,6 +635,8 @@ def get_active_subscription(telegram_id: int, use_cache: bool = True) -> Optiona
         
         if subscription:
             set_cached_subscription(telegram_id, subscription)
+        else:
+            cache_no_subscription(telegram_id, version)
         
         return subscription
         
@@ -300,6 +645,48 @@ def get_active_subscription(telegram_id: int, use_cache: bool = True) -> Optiona
         return None
 
 
+def load_paying_users(page_size: int = 1000) -> bool:
+    """Load ids of users with an active subscription into the negative cache"""
+    global _paying_users_loaded
+    
+    try:
+        offset = 0
+        while True:
+            result = supabase.table('subscriptions')\
+                .select('user_id')\
+                .eq('status', 'active')\
+                .gte('end_date', datetime.now(timezone.utc).isoformat())\
+                .range(offset, offset + page_size - 1)\
+                .execute()
+            
+            _paying_users.update(row['user_id'] for row in result.data)
+            if len(result.data) < page_size:
+                break
+            offset += page_size
+        
+        _paying_users_loaded = True
+        logger.info(f"Loaded {len(_paying_users)} paying users")
+        return True
+        
+    except Exception as e:
+        logger.error(f"Error loading paying users (negative cache disabled): {e}")
+        return False
+
+
+# Invoice payload parts that never change between invoices (read-only by convention)
+BTCPAY_INVOICE_METADATA = {
+    'subscriptionDays': str(SUBSCRIPTION_DAYS),
+    'basePrice': str(SUBSCRIPTION_PRICE),
+    'feePercent': str(PROCESSING_FEE_PERCENT),
+}
+BTCPAY_INVOICE_CHECKOUT = {
+    'speedPolicy': 'HighSpeed',
+    'paymentMethods': ['BTC', 'BTC-LightningNetwork'],
+    'expirationMinutes': MAX_INVOICE_AGE_MINUTES,
+    'redirectURL': BOT_REDIRECT_URL
+}
+
+
 async def create_btcpay_invoice(telegram_id: int, amount: float) -> Optional[Dict]:
     """Create invoice in BTCPay Server"""
     if not validate_telegram_id(telegram_id):
@@ -309,46 +696,31 @@ async def create_btcpay_invoice(telegram_id: int, amount: float) -> Optional[Dic
         logger.error(f"Invalid amount: {amount}")
         return None
     
+    # Epoch seconds (UTC) without building a datetime
+    order_id = f'sub_{telegram_id}_{time.time_ns() // 1_000_000_000}'
+    
+    payload = {
+        'amount': str(round(amount, 2)),
+        'currency': 'USD',
+        'metadata': {
+            'orderId': order_id,
+            'userId': str(telegram_id),
+            **BTCPAY_INVOICE_METADATA,
+            'totalPrice': str(amount)
+        },
+        'checkout': BTCPAY_INVOICE_CHECKOUT
+    }
+    body = orjson.dumps(payload)
+    
     max_retries = 3
     retry_delay = 1
     
     for attempt in range(max_retries):
         try:
-            # Clean up URL to avoid duplication
-            base_url = BTCPAY_URL.rstrip('/').split('/stores/')[0]
-            url = f"{base_url}/api/v1/stores/{BTCPAY_STORE_ID}/invoices"
-            
-            headers = {
-                'Authorization': f'token {BTCPAY_API_KEY}',
-                'Content-Type': 'application/json'
-            }
-            
-            # FIX: Use UTC timestamp
-            order_id = f'sub_{telegram_id}_{int(datetime.now(timezone.utc).timestamp())}'
-            
-            payload = {
-                'amount': str(round(amount, 2)),
-                'currency': 'USD',
-                'metadata': {
-                    'orderId': order_id,
-                    'userId': str(telegram_id),
-                    'subscriptionDays': str(SUBSCRIPTION_DAYS),
-                    'basePrice': str(SUBSCRIPTION_PRICE),
-                    'feePercent': str(PROCESSING_FEE_PERCENT),
-                    'totalPrice': str(amount)
-                },
-                'checkout': {
-                    'speedPolicy': 'HighSpeed',
-                    'paymentMethods': ['BTC', 'BTC-LightningNetwork'],
-                    'expirationMinutes': MAX_INVOICE_AGE_MINUTES,
-                    'redirectURL': f'https://t.me/{os.getenv("BOT_USERNAME", "your_bot")}'
-                }
-            }
-            
-            response = await http_client.post(url, json=payload, headers=headers)
+            response = await http_client.post(BTCPAY_INVOICE_URL, content=body, headers=BTCPAY_HEADERS)
             response.raise_for_status()
             
-            invoice_data = response.json()
+            invoice_data = orjson.loads(response.content)
             logger.info(f"Invoice created: {invoice_data['id']} for user {telegram_id} - ${amount}")
             return invoice_data
             
@@ -393,6 +765,8 @@ def save_payment(telegram_id: int, invoice_data: Dict) -> Optional[Dict]:
         
         if result.data:
             logger.info(f"Payment saved: {payment['btcpay_invoice_id']}")
+            # Warm the cache so the settlement webhook skips its SELECT
+            set_cached_payment(payment['btcpay_invoice_id'], result.data[0])
             return result.data[0]
         
         return None
@@ -403,65 +777,23 @@ def save_payment(telegram_id: int, invoice_data: Dict) -> Optional[Dict]:
 
 
 def create_or_extend_subscription(telegram_id: int, amount: float, invoice_id: str) -> Optional[Dict]:
-    """Create new or extend existing subscription"""
+    """Create new or extend existing subscription (single atomic upsert)"""
     if not validate_telegram_id(telegram_id):
         return None
     
     try:
-        result = supabase.table('subscriptions')\
-            .select('*')\
-            .eq('user_id', telegram_id)\
-            .eq('status', 'active')\
-            .order('end_date', desc=True)\
-            .limit(1)\
-            .execute()
-        
-        # FIX: Use UTC now
-        now = datetime.now(timezone.utc)
+        result = supabase.rpc('extend_or_create_subscription', {
+            'p_user_id': telegram_id,
+            'p_amount': amount,
+            'p_days': SUBSCRIPTION_DAYS
+        }).execute()
         
         if result.data:
             subscription = result.data[0]
-            # This comes from DB, likely already aware
-            current_end = datetime.fromisoformat(subscription['end_date'])
-            # Ensure current_end is aware if it wasn't
-            if current_end.tzinfo is None:
-                current_end = current_end.replace(tzinfo=timezone.utc)
-                
-            new_end = max(current_end, now) + timedelta(days=SUBSCRIPTION_DAYS)
-            
-            update_result = supabase.table('subscriptions')\
-                .update({
-                    'end_date': new_end.isoformat(),
-                    'updated_at': now.isoformat()
-                })\
-                .eq('id', subscription['id'])\
-                .execute()
-            
-            if update_result.data:
-                invalidate_subscription_cache(telegram_id)
-                logger.info(f"Subscription extended for user {telegram_id} until {new_end}")
-                return update_result.data[0]
-        else:
-            end_date = now + timedelta(days=SUBSCRIPTION_DAYS)
-            
-            new_subscription = {
-                'user_id': telegram_id,
-                'status': 'active',
-                'plan_type': 'monthly',
-                'amount_paid': amount,
-                'start_date': now.isoformat(),
-                'end_date': end_date.isoformat(),
-                'created_at': now.isoformat()
-            }
-            
-            insert_result = supabase.table('subscriptions')\
-                .insert(new_subscription)\
-                .execute()
-            
-            if insert_result.data:
-                invalidate_subscription_cache(telegram_id)
-                logger.info(f"New subscription created for user {telegram_id} until {end_date}")
-                return insert_result.data[0]
+            mark_paying_user(telegram_id)
+            invalidate_subscription_cache(telegram_id)
+            logger.info(f"Subscription active for user {telegram_id} until {subscription['end_date']}")
+            return subscription
         
         return None
         
@@ -471,538 +803,586 @@ def create_or_extend_subscription(telegram_id: int, amount: float, invoice_id: s
 
 
 def log_activity(user_id: int, action: str, details: Dict = None):
-    """Log user activity"""
+    """Queue user activity for the background batch writer"""
     if not validate_telegram_id(user_id):
         return
     
+    activity = {
+        'user_id': user_id,
+        'action': sanitize_string(action, 50),
+        'details': details or {},
+        'created_at': datetime.now(timezone.utc).isoformat()
+    }
+    
     try:
-        activity = {
-            'user_id': user_id,
-            'action': sanitize_string(action, 50),
-            'details': details or {},
-            'created_at': datetime.now(timezone.utc).isoformat()
-        }
-        
-        supabase.table('activity_logs').insert(activity).execute()
-        
+        activity_queue.put_nowait(activity)
+    except queue.Full:
+        logger.warning(f"Activity queue full - dropping '{activity['action']}' for user {user_id}")
+        return
+    
+    if activity_queue.qsize() >= ACTIVITY_BATCH_SIZE:
+        activity_flush_event.set()
+
+
+def flush_activities() -> int:
+    """Insert up to one batch of queued activity rows, returns rows taken"""
+    batch = []
+    while len(batch) < ACTIVITY_BATCH_SIZE:
+        try:
+            batch.append(activity_queue.get_nowait())
+        except queue.Empty:
+            break
+    
+    if not batch:
+        return 0
+    
+    try:
+        supabase.table('activity_logs').insert(batch).execute()
     except Exception as e:
-        logger.error(f"Error logging activity: {e}")
+        logger.error(f"Error logging activity batch ({len(batch)} rows): {e}")
+    return len(batch)
+
+
+def drain_activities():
+    """Flush everything still queued (used at shutdown)"""
+    while flush_activities() == ACTIVITY_BATCH_SIZE:
+        pass
+
+
+def _activity_flusher():
+    """Background loop: flush every interval, or early when a batch fills up"""
+    while True:
+        activity_flush_event.wait(ACTIVITY_FLUSH_INTERVAL)
+        activity_flush_event.clear()
+        drain_activities()
+
+
+threading.Thread(target=_activity_flusher, daemon=True, name="ActivityFlusher").start()
+atexit.register(drain_activities)
+
+
+def _encode_qr_png(payment_url: str) -> bytes:
+    """Render the QR code PNG for a payment URL (runs on qr_executor threads)"""
+    # segno writes a 1-bit PNG directly, no PIL raster round-trip
+    qr = segno.make(payment_url, error='l', micro=False)
+    
+    bio = BytesIO()
+    qr.save(bio, kind='png', scale=10, border=4, dark='black', light='white')
+    return bio.getvalue()
+
 
+# Rendered PNG bytes per URL; a hit skips the worker pool entirely
+_qr_png_cache = LRUCache(maxsize=QR_CACHE_SIZE)
+_qr_png_cache_lock = threading.Lock()
 
-def generate_qr_code(payment_url: str) -> Optional[BytesIO]:
-    """Generate QR code image for payment URL"""
+
+def _qr_image(png: bytes) -> BytesIO:
+    """Wrap PNG bytes in a fresh named BytesIO for upload"""
+    bio = BytesIO(png)
+    bio.name = 'qr_code.png'
+    return bio
+
+
+async def generate_qr_code_async(payment_url: str) -> Optional[BytesIO]:
+    """Generate QR code on the QR thread pool (event loop never blocks)"""
+    with _qr_png_cache_lock:
+        png = _qr_png_cache.get(payment_url)
+    
+    if png is None:
+        try:
+            loop = asyncio.get_running_loop()
+            png = await loop.run_in_executor(qr_executor, _encode_qr_png, payment_url)
+        except Exception as e:
+            logger.error(f"Error generating QR code: {e}")
+            return None
+        with _qr_png_cache_lock:
+            _qr_png_cache[payment_url] = png
+    
+    return _qr_image(png)
+
+
+def get_qr_file_id(digest: str) -> Optional[str]:
+    """Telegram file_id of a previously uploaded QR PNG, if known"""
+    if not cache:
+        return None
     try:
-        qr = qrcode.QRCode(
-            version=1,
-            error_correction=qrcode.constants.ERROR_CORRECT_L,
-            box_size=10,
-            border=4,
-        )
-        qr.add_data(payment_url)
-        qr.make(fit=True)
-        
-        img = qr.make_image(fill_color="black", back_color="white")
-        
-        # Convert to bytes
-        bio = BytesIO()
-        bio.name = 'qr_code.png'
-        img.save(bio, 'PNG')
-        bio.seek(0)
-        
-        return bio
+        file_id = cache.get(f"qr_fid:{digest}")
+        return file_id.decode() if file_id else None
     except Exception as e:
-        logger.error(f"Error generating QR code: {e}")
+        logger.error(f"QR file_id cache get error: {e}")
         return None
 
 
+def set_qr_file_id(digest: str, file_id: str):
+    """Remember the Telegram file_id for an uploaded QR PNG"""
+    if not cache:
+        return
+    try:
+        cache.setex(f"qr_fid:{digest}", QR_FILE_ID_TTL, file_id)
+    except Exception as e:
+        logger.error(f"QR file_id cache set error: {e}")
+
+
+async def send_qr_photo(bot, chat_id: int, qr_image: BytesIO, **kwargs):
+    """Send a QR photo, re-using Telegram's file_id instead of re-uploading identical PNGs"""
+    digest = hashlib.sha256(qr_image.getvalue()).hexdigest()
+    file_id = await run_db(get_qr_file_id, digest)
+    
+    if file_id:
+        try:
+            return await bot.send_photo(chat_id=chat_id, photo=file_id, **kwargs)
+        except TelegramError as e:
+            logger.warning(f"Cached QR file_id rejected, re-uploading: {e}")
+    
+    message = await bot.send_photo(chat_id=chat_id, photo=qr_image, **kwargs)
+    if message.photo:
+        await run_db(set_qr_file_id, digest, message.photo[-1].file_id)
+    return message
+
+
+# ==========================================
+# STATIC MENUS & MESSAGES
+# ==========================================
+# Built once at import: these only depend on module constants
+MAIN_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("💎 Subscribe / Renew", callback_data='menu_subscribe')],
+    [InlineKeyboardButton("📊 My Status", callback_data='menu_status')],
+    [InlineKeyboardButton("📦 Plans", callback_data='menu_plans')],
+    [InlineKeyboardButton("❓ How it works", callback_data='menu_how')],
+    [InlineKeyboardButton("🆘 Support", callback_data='menu_support')]
+])
+SUBSCRIBE_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("⚡️ Pay with Bitcoin/Lightning", callback_data='create_invoice')],
+    [InlineKeyboardButton("« Back to Menu", callback_data='back_to_menu')]
+])
+BACK_TO_MENU_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("« Back to Menu", callback_data='back_to_menu')]])
+BACK_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("« Back", callback_data='back_to_menu')]])
+BACK_TO_SUBSCRIBE_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("« Back", callback_data='menu_subscribe')]])
+
+SUBSCRIBE_TEXT = (
+    f"💎 <b>Premium Subscription</b>\n\n"
+    f"💰 Price: ${TOTAL_SUBSCRIPTION_PRICE:.2f}\n"
+    f"⏱ Duration: {SUBSCRIPTION_DAYS} days\n"
+    f"⚡️ Payment: Bitcoin or Lightning Network\n\n"
+    f"✨ <b>What you get:</b>\n"
+    f"• Instant activation\n"
+    f"• Access to all premium content\n"
+    f"• Priority support\n"
+    f"• Automatic renewal reminders\n\n"
+    f"🔒 <b>Secure payment via BTCPay Server</b>\n"
+    f"Your privacy is protected!"
+)
+
+STATUS_INACTIVE_TEXT = (
+    f"📊 <b>Subscription Status</b>\n\n"
+    f"❌ Status: <b>Inactive</b>\n"
+    f"💰 Price: ${TOTAL_SUBSCRIPTION_PRICE:.2f}/{SUBSCRIPTION_DAYS}d\n\n"
+    f"Tap Subscribe to get started!"
+)
+
+PLANS_TEXT = (
+    f"💰 <b>Subscription Plans</b>\n\n"
+    f"<b>Monthly Plan:</b>\n"
+    f"💵 ${TOTAL_SUBSCRIPTION_PRICE:.2f} for {SUBSCRIPTION_DAYS} days\n\n"
+    f"✨ <b>What's included:</b>\n"
+    f"• Priority support\n"
+    f"Tap Subscribe to get started!"
+)
+
+HOW_TEXT = (
+    "❓ <b>How It Works</b>\n\n"
+    "<b>Step 1:</b> Tap 💎 Subscribe\n"
+    "<b>Step 2:</b> Pay with Bitcoin or Lightning\n"
+    "<b>Step 3:</b> Get instant access!\n\n"
+    "💳 <b>Payment:</b>\n"
+    "We accept Bitcoin and Lightning Network payments via BTCPay Server. "
+    "Your payment is secure and private.\n\n"
+    "⚡ <b>Instant Activation:</b>\n"
+    "Your subscription activates automatically within seconds of payment.\n\n"
+    "📱 <b>Access:</b>\n"
+    "Once subscribed, you'll get access to all paid chat features!"
+)
+
+SUPPORT_TEXT = (
+    "🆘 <b>Support</b>\n\n"
+    "Need help? We're here for you!\n\n"
+    "📧 <b>Contact:</b>\n"
+    "• Email: betterpickz@proton.me\n"
+    "• Telegram: @CyphyrX\n\n"
+    "⏰ <b>Response Time:</b>\n"
+    "We typically respond within 24 hours.\n\n"
+    "💡 <b>Quick Help:</b>\n"
+    "• Payment issues: Check your wallet\n"
+    "• Subscription status: Tap 📊 My Status\n"
+    "• Technical problems: Send /start\n\n"
+    "<b>Common Questions:</b>\n"
+    "Q: How do I subscribe?\n"
+    "A: Tap 💎 Subscribe and follow the steps\n\n"
+    "Q: What payment methods?\n"
+    "A: Bitcoin & Lightning Network\n\n"
+    "Q: Instant access?\n"
+    "A: Yes! Activates in seconds"
+)
+
+PLAN_LINE = f"💰 Plan: ${TOTAL_SUBSCRIPTION_PRICE:.2f} / {SUBSCRIPTION_DAYS} days\n"
+STATUS_ACTIVE_LINE = "📊 Your status: ✅ Active\n\n"
+STATUS_EXPIRED_LINE = "📊 Your status: ❌ Expired\n\n"
+STATUS_NOT_ACTIVE_LINE = "📊 Your status: ❌ Not active\n\n"
+MANAGE_PROMPT = "Tap below to manage your subscription 👇"
+
+MENU_WELCOME_TEXT = f"👋 Welcome!\n\n{PLAN_LINE}{STATUS_NOT_ACTIVE_LINE}{MANAGE_PROMPT}"
+WELCOME_BACK_ACTIVE_TEXT = f"👋 Welcome back!\n\n{PLAN_LINE}{STATUS_ACTIVE_LINE}{MANAGE_PROMPT}"
+WELCOME_BACK_EXPIRED_TEXT = f"👋 Welcome back!\n\n{PLAN_LINE}{STATUS_EXPIRED_LINE}{MANAGE_PROMPT}"
+
+# Per-user messages: constant parts are baked in at import, only the slots
+# are filled per call with str.format_map
+WELCOME_TMPL = "👋 Welcome, {name}!\n\n" + PLAN_LINE + "{status_line}" + MANAGE_PROMPT
+
+STATUS_ACTIVE_TMPL = (
+    "📊 <b>Subscription Status</b>\n\n"
+    "{emoji} Status: <b>Active</b>\n"
+    "📅 Expires: {date}\n"
+    "⏳ Days remaining: <b>{days}</b>\n"
+    "💰 Plan: ${amount:.2f}/" + str(SUBSCRIPTION_DAYS) + "d\n\n"
+    "{tail}"
+)
+STATUS_RENEW_SOON_TAIL = "⚠️ Renew soon to avoid interruption!"
+STATUS_OK_TAIL = "✨ Enjoying premium access!"
+
+
 # ==========================================
 # BOT COMMAND HANDLERS
 # ==========================================
+# (chat_id, message_id) -> hash of the text + keyboard last rendered there.
+# Repeat taps that would render the same content skip the editMessageText call
+# (Telegram would only answer "message is not modified").
+LAST_EDIT_CACHE_SIZE = 10000
+_last_edits = OrderedDict()
+
+
+async def edit_message(query, text: str, reply_markup=None, parse_mode=None):
+    """edit_message_text that skips no-op edits of the callback's message"""
+    message = query.message
+    if not message:
+        return await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=parse_mode)
+    
+    key = (message.chat_id, message.message_id)
+    rendered = hash((text, reply_markup))
+    if _last_edits.get(key) == rendered:
+        _last_edits.move_to_end(key)
+        return None
+    
+    # Recorded before the await so a concurrent double tap sees it
+    _last_edits[key] = rendered
+    _last_edits.move_to_end(key)
+    if len(_last_edits) > LAST_EDIT_CACHE_SIZE:
+        _last_edits.popitem(last=False)
+    
+    try:
+        return await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=parse_mode)
+    except Exception:
+        if _last_edits.get(key) == rendered:
+            del _last_edits[key]
+        raise
+
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /start command with inline menu"""
     user = update.effective_user
     telegram_id = user.id
     
-    if not rate_limit_check(telegram_id, "start"):
+    if not await run_db(rate_limit_check, telegram_id, "start"):
         await update.message.reply_text("⏱ Please slow down. Try again in a minute.")
         return
     
-    db_user = get_or_create_user(telegram_id, user.username, user.first_name)
+    # Fresh user + subscription in one round-trip (cached for fast button clicks)
+    db_user, subscription = await run_db(get_user_with_active_subscription, telegram_id, user.username, user.first_name)
     if not db_user:
         await update.message.reply_text(
             "❌ Service temporarily unavailable. Please try again later."
         )
         return
     
-    # Preload subscription data (will be cached for fast button clicks)
-    subscription = get_active_subscription(telegram_id, use_cache=False)  # Fresh data on start
     log_activity(telegram_id, 'command_start')
     
-    # Create inline menu
-    keyboard = [
-        [InlineKeyboardButton("💎 Subscribe / Renew", callback_data='menu_subscribe')],
-        [InlineKeyboardButton("📊 My Status", callback_data='menu_status')],
-        [InlineKeyboardButton("📦 Plans", callback_data='menu_plans')],
-        [InlineKeyboardButton("❓ How it works", callback_data='menu_how')],
-        [InlineKeyboardButton("🆘 Support", callback_data='menu_support')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    if subscription:
+        status_line = STATUS_ACTIVE_LINE if days_left(subscription) > 0 else STATUS_EXPIRED_LINE
+    else:
+        status_line = STATUS_NOT_ACTIVE_LINE
+    
+    await update.message.reply_text(
+        WELCOME_TMPL.format_map({'name': sanitize_string(user.first_name), 'status_line': status_line}),
+        reply_markup=MAIN_MENU_MARKUP,
+        parse_mode='HTML'
+    )
+
+
+async def _menu_subscribe(query, context: ContextTypes.DEFAULT_TYPE):
+    """Menu: Subscribe"""
+    await edit_message(query, SUBSCRIBE_TEXT, reply_markup=SUBSCRIBE_MARKUP, parse_mode='HTML')
+
+
+async def _menu_status(query, context: ContextTypes.DEFAULT_TYPE):
+    """Menu: Status"""
+    telegram_id = query.from_user.id
+    
+    # Use cached data for instant response!
+    subscription = await run_db(get_active_subscription, telegram_id, use_cache=True)
     
     if subscription:
-        # FIX: Handle timezone awareness
-        end_date = datetime.fromisoformat(subscription['end_date'])
-        if end_date.tzinfo is None:
-            end_date = end_date.replace(tzinfo=timezone.utc)
-            
-        # FIX: Use UTC now
-        days_left = (end_date - datetime.now(timezone.utc)).days
-        status_text = "✅ Active" if days_left > 0 else "❌ Expired"
+        remaining = days_left(subscription)
+        renew_soon = remaining <= 7
         
-        await update.message.reply_text(
-            f"👋 Welcome, {sanitize_string(user.first_name)}!\n\n"
-            f"💰 Plan: ${TOTAL_SUBSCRIPTION_PRICE:.2f} / {SUBSCRIPTION_DAYS} days\n"
-            f"📊 Your status: {status_text}\n\n"
-            f"Tap below to manage your subscription 👇",
-            reply_markup=reply_markup,
+        await edit_message(
+            query,
+            STATUS_ACTIVE_TMPL.format_map({
+                'emoji': "⚠️" if renew_soon else "✅",
+                'date': format_end_date(subscription['end_date']),
+                'days': remaining,
+                'amount': subscription.get('amount_paid', SUBSCRIPTION_PRICE),
+                'tail': STATUS_RENEW_SOON_TAIL if renew_soon else STATUS_OK_TAIL,
+            }),
+            reply_markup=BACK_TO_MENU_MARKUP,
             parse_mode='HTML'
         )
     else:
-        await update.message.reply_text(
-            f"👋 Welcome, {sanitize_string(user.first_name)}!\n\n"
-            f"💰 Plan: ${TOTAL_SUBSCRIPTION_PRICE:.2f} / {SUBSCRIPTION_DAYS} days\n"
-            f"📊 Your status: ❌ Not active\n\n"
-            f"Tap below to manage your subscription 👇",
-            reply_markup=reply_markup,
-            parse_mode='HTML'
-        )
+        await edit_message(query, STATUS_INACTIVE_TEXT, reply_markup=BACK_TO_MENU_MARKUP, parse_mode='HTML')
 
 
-async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle all button clicks - optimized for speed"""
-    query = update.callback_query
+# Screens that are identical for every user, rendered straight from constants
+STATIC_SCREENS = {
+    'menu_plans': PLANS_TEXT,
+    'menu_how': HOW_TEXT,
+    'menu_support': SUPPORT_TEXT,
+}
+
+async def _menu_static(query, context: ContextTypes.DEFAULT_TYPE):
+    """Menu: Plans / How it works / Support"""
+    await edit_message(query, STATIC_SCREENS[query.data], reply_markup=BACK_TO_MENU_MARKUP, parse_mode='HTML')
+
+
+async def _back_to_menu(query, context: ContextTypes.DEFAULT_TYPE):
+    """Back to main menu"""
+    telegram_id = query.from_user.id
     
-    # INSTANT acknowledgment to Telegram (makes it feel faster!)
-    await query.answer()
+    subscription = await run_db(get_active_subscription, telegram_id)
     
-    user = query.from_user
-    telegram_id = user.id
+    if subscription:
+        text = WELCOME_BACK_ACTIVE_TEXT if days_left(subscription) > 0 else WELCOME_BACK_EXPIRED_TEXT
+    else:
+        text = MENU_WELCOME_TEXT
     
-    # Menu: Subscribe
-    if query.data == 'menu_subscribe':
-        keyboard = [
-            [InlineKeyboardButton("⚡️ Pay with Bitcoin/Lightning", callback_data='create_invoice')],
-            [InlineKeyboardButton("« Back to Menu", callback_data='back_to_menu')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+    # Check if message has photo (QR code)
+    if query.message.photo:
+        # Delete photo message, send new text message
+        try:
+            await query.message.delete()
+        except:
+            pass
         
-        await query.edit_message_text(
-            f"💎 <b>Premium Subscription</b>\n\n"
-            f"💰 Price: ${TOTAL_SUBSCRIPTION_PRICE:.2f}\n"
-            f"⏱ Duration: {SUBSCRIPTION_DAYS} days\n"
-            f"⚡️ Payment: Bitcoin or Lightning Network\n\n"
-            f"✨ <b>What you get:</b>\n"
-            f"• Instant activation\n"
-            f"• Access to all premium content\n"
-            f"• Priority support\n"
-            f"• Automatic renewal reminders\n\n"
-            f"🔒 <b>Secure payment via BTCPay Server</b>\n"
-            f"Your privacy is protected!",
-            reply_markup=reply_markup,
+        await context.bot.send_message(
+            chat_id=telegram_id,
+            text=text,
+            reply_markup=MAIN_MENU_MARKUP,
             parse_mode='HTML'
         )
-        return
+    else:
+        # Normal text message, can edit
+        await edit_message(query, text, reply_markup=MAIN_MENU_MARKUP, parse_mode='HTML')
+
+
+# telegram_id -> in-flight invoice flow. A double tap joins the running flow
+# instead of creating a second BTCPay invoice and payment row.
+_pending_invoices: Dict[int, asyncio.Task] = {}
+
+
+def single_invoice_flow(handler):
+    """Run at most one invoice flow per user at a time"""
+    @wraps(handler)
+    async def wrapper(query, context: ContextTypes.DEFAULT_TYPE):
+        telegram_id = query.from_user.id
+        task = _pending_invoices.get(telegram_id)
+        if task is None:
+            task = asyncio.create_task(handler(query, context))
+            _pending_invoices[telegram_id] = task
+            task.add_done_callback(lambda _: _pending_invoices.pop(telegram_id, None))
+        await asyncio.shield(task)
+    return wrapper
+
+
+# Per-entry-point copy for the shared invoice flow
+RENEW_INVOICE_FLOW = {
+    'loading': "⏳ <b>Creating your renewal invoice...</b>\n\nOne moment! ⚡",
+    'title': "✅ <b>Renewal Invoice Created!</b>\n\n",
+    'outro': "Your subscription will extend automatically! 🎉\n\n",
+    'back_markup': BACK_MARKUP,
+    'failed_action': 'renewal_invoice_failed',
+    'created_action': 'renewal_invoice_created',
+}
+
+CREATE_INVOICE_FLOW = {
+    'loading': "⏳ <b>Creating your payment invoice...</b>\n\nHang tight! This will just take a moment! ⚡",
+    'title': "✅ <b>Invoice Created!</b>\n\n",
+    'outro': "You'll receive confirmation automatically! 🎉\n\n",
+    'back_markup': BACK_TO_SUBSCRIBE_MARKUP,
+    'failed_action': 'invoice_creation_failed',
+    'created_action': 'invoice_created',
+}
+
+INVOICE_DETAILS_TEXT = (
+    f"💰 Amount: ${TOTAL_SUBSCRIPTION_PRICE:.2f}\n"
+    f"⏱ Valid for: {MAX_INVOICE_AGE_MINUTES} minutes\n"
+    f"⚡️ Payment: BTC or Lightning\n\n"
+)
+
+# Full invoice message templates per flow; only the invoice id varies
+for _flow in (RENEW_INVOICE_FLOW, CREATE_INVOICE_FLOW):
+    _flow['qr_caption_tmpl'] = (
+        _flow['title'] + INVOICE_DETAILS_TEXT +
+        "📱 <b>Scan QR code above with your wallet</b>\n"
+        "Or click 'Open in Browser' to pay\n\n" +
+        _flow['outro'] + "<i>Invoice ID: {invoice_id}...</i>"
+    )
+    _flow['link_text_tmpl'] = (
+        _flow['title'] + INVOICE_DETAILS_TEXT +
+        "Click <b>Pay Now</b> to open the payment page.\n" +
+        _flow['outro'] + "<i>Invoice ID: {invoice_id}...</i>"
+    )
+
+
+async def _edit_message_quietly(query, text: str, **kwargs):
+    """edit_message for cosmetic updates: failures are logged, not raised"""
+    try:
+        return await edit_message(query, text, **kwargs)
+    except Exception as e:
+        logger.warning(f"Message edit failed: {e}")
+        return None
+
+
+async def _invoice_flow(query, context: ContextTypes.DEFAULT_TYPE, flow: Dict[str, Any]):
+    """Create a BTCPay invoice, record the payment and show the QR / pay link"""
+    telegram_id = query.from_user.id
     
-    # Menu: Status
-    elif query.data == 'menu_status':
-        # Use cached data for instant response!
-        subscription = get_active_subscription(telegram_id, use_cache=True)
-        
-        keyboard = [[InlineKeyboardButton("« Back to Menu", callback_data='back_to_menu')]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+    try:
+        # Show loading immediately while the BTCPay call is in flight; only
+        # the invoice result decides the flow (a failed cosmetic edit must not
+        # orphan an invoice that was already created)
+        invoice_data, _ = await asyncio.gather(
+            create_btcpay_invoice(telegram_id, TOTAL_SUBSCRIPTION_PRICE),
+            _edit_message_quietly(query, flow['loading'], parse_mode='HTML')
+        )
         
-        if subscription:
-            # FIX: Timezone aware comparison
-            end_date = datetime.fromisoformat(subscription['end_date'])
-            if end_date.tzinfo is None:
-                end_date = end_date.replace(tzinfo=timezone.utc)
-                
-            days_left = (end_date - datetime.now(timezone.utc)).days
-            status_emoji = "✅" if days_left > 7 else "⚠️"
-            
-            await query.edit_message_text(
-                f"📊 <b>Subscription Status</b>\n\n"
-                f"{status_emoji} Status: <b>Active</b>\n"
-                f"📅 Expires: {end_date.strftime('%B %d, %Y')}\n"
-                f"⏳ Days remaining: <b>{days_left}</b>\n"
-                f"💰 Plan: ${subscription.get('amount_paid', SUBSCRIPTION_PRICE):.2f}/{SUBSCRIPTION_DAYS}d\n\n"
-                f"{'⚠️ Renew soon to avoid interruption!' if days_left <= 7 else '✨ Enjoying premium access!'}",
-                reply_markup=reply_markup,
-                parse_mode='HTML'
-            )
-        else:
-            await query.edit_message_text(
-                f"📊 <b>Subscription Status</b>\n\n"
-                f"❌ Status: <b>Inactive</b>\n"
-                f"💰 Price: ${TOTAL_SUBSCRIPTION_PRICE:.2f}/{SUBSCRIPTION_DAYS}d\n\n"
-                f"Tap Subscribe to get started!",
-                reply_markup=reply_markup,
-                parse_mode='HTML'
+        if not invoice_data:
+            await edit_message(
+                query,
+                "❌ Unable to create invoice right now.\n"
+                "Please try again in a few moments or contact support.",
+                reply_markup=flow['back_markup']
             )
-        return
-    
-    # Menu: Plans
-    elif query.data == 'menu_plans':
-        keyboard = [[InlineKeyboardButton("« Back to Menu", callback_data='back_to_menu')]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await query.edit_message_text(
-            f"💰 <b>Subscription Plans</b>\n\n"
-            f"<b>Monthly Plan:</b>\n"
-            f"💵 ${TOTAL_SUBSCRIPTION_PRICE:.2f} for {SUBSCRIPTION_DAYS} days\n\n"
-            f"✨ <b>What's included:</b>\n"
-            f"• Priority support\n"
-            f"Tap Subscribe to get started!",
-            reply_markup=reply_markup,
-            parse_mode='HTML'
-        )
-        return
-    
-    # Menu: How it works
-    elif query.data == 'menu_how':
-        keyboard = [[InlineKeyboardButton("« Back to Menu", callback_data='back_to_menu')]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+            log_activity(telegram_id, flow['failed_action'])
+            return
         
-        await query.edit_message_text(
-            f"❓ <b>How It Works</b>\n\n"
-            f"<b>Step 1:</b> Tap 💎 Subscribe\n"
-            f"<b>Step 2:</b> Pay with Bitcoin or Lightning\n"
-            f"<b>Step 3:</b> Get instant access!\n\n"
-            f"💳 <b>Payment:</b>\n"
-            f"We accept Bitcoin and Lightning Network payments via BTCPay Server. "
-            f"Your payment is secure and private.\n\n"
-            f"⚡ <b>Instant Activation:</b>\n"
-            f"Your subscription activates automatically within seconds of payment.\n\n"
-            f"📱 <b>Access:</b>\n"
-            f"Once subscribed, you'll get access to all paid chat features!",
-            reply_markup=reply_markup,
-            parse_mode='HTML'
+        # Persist the payment and render the QR side by side
+        checkout_link = invoice_data['checkoutLink']
+        payment, qr_image = await asyncio.gather(
+            run_db(save_payment, telegram_id, invoice_data),
+            generate_qr_code_async(checkout_link)
         )
-        return
-    
-    # Menu: Support
-    elif query.data == 'menu_support':
-        keyboard = [[InlineKeyboardButton("« Back to Menu", callback_data='back_to_menu')]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
         
-        await query.edit_message_text(
-            f"🆘 <b>Support</b>\n\n"
-            f"Need help? We're here for you!\n\n"
-            f"📧 <b>Contact:</b>\n"
-            f"• Email: betterpickz@proton.me\n"
-            f"• Telegram: @CyphyrX\n\n"
-            f"⏰ <b>Response Time:</b>\n"
-            f"We typically respond within 24 hours.\n\n"
-            f"💡 <b>Quick Help:</b>\n"
-            f"• Payment issues: Check your wallet\n"
-            f"• Subscription status: Tap 📊 My Status\n"
-            f"• Technical problems: Send /start\n\n"
-            f"<b>Common Questions:</b>\n"
-            f"Q: How do I subscribe?\n"
-            f"A: Tap 💎 Subscribe and follow the steps\n\n"
-            f"Q: What payment methods?\n"
-            f"A: Bitcoin & Lightning Network\n\n"
-            f"Q: Instant access?\n"
-            f"A: Yes! Activates in seconds",
-            reply_markup=reply_markup,
-            parse_mode='HTML'
-        )
-        return
-    
-    # Back to main menu
-    elif query.data == 'back_to_menu':
-        subscription = get_active_subscription(telegram_id)
+        if not payment:
+            await edit_message(
+                query,
+                "❌ Error processing request.\n"
+                "Please try again or contact support.",
+                reply_markup=flow['back_markup']
+            )
+            return
         
-        keyboard = [
-            [InlineKeyboardButton("💎 Subscribe / Renew", callback_data='menu_subscribe')],
-            [InlineKeyboardButton("📊 My Status", callback_data='menu_status')],
-            [InlineKeyboardButton("📦 Plans", callback_data='menu_plans')],
-            [InlineKeyboardButton("❓ How it works", callback_data='menu_how')],
-            [InlineKeyboardButton("🆘 Support", callback_data='menu_support')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        invoice_slots = {'invoice_id': invoice_data['id'][:8]}
         
-        # Check if message has photo (QR code)
-        if query.message.photo:
-            # Delete photo message, send new text message
+        # Send QR code as photo
+        if qr_image:
+            # First, delete the loading message
             try:
                 await query.message.delete()
             except:
-                pass
-            
-            if subscription:
-                # FIX: Timezone awareness
-                end_date = datetime.fromisoformat(subscription['end_date'])
-                if end_date.tzinfo is None:
-                    end_date = end_date.replace(tzinfo=timezone.utc)
-                    
-                days_left = (end_date - datetime.now(timezone.utc)).days
-                status_text = "✅ Active" if days_left > 0 else "❌ Expired"
-                
-                await context.bot.send_message(
-                    chat_id=telegram_id,
-                    text=f"👋 Welcome back!\n\n"
-                         f"💰 Plan: ${TOTAL_SUBSCRIPTION_PRICE:.2f} / {SUBSCRIPTION_DAYS} days\n"
-                         f"📊 Your status: {status_text}\n\n"
-                         f"Tap below to manage your subscription 👇",
-                    reply_markup=reply_markup,
-                    parse_mode='HTML'
-                )
-            else:
-                await context.bot.send_message(
-                    chat_id=telegram_id,
-                    text=f"👋 Welcome!\n\n"
-                         f"💰 Plan: ${TOTAL_SUBSCRIPTION_PRICE:.2f} / {SUBSCRIPTION_DAYS} days\n"
-                         f"📊 Your status: ❌ Not active\n\n"
-                         f"Tap below to manage your subscription 👇",
-                    reply_markup=reply_markup,
-                    parse_mode='HTML'
-                )
-        else:
-            # Normal text message, can edit
-            if subscription:
-                # FIX: Timezone awareness
-                end_date = datetime.fromisoformat(subscription['end_date'])
-                if end_date.tzinfo is None:
-                    end_date = end_date.replace(tzinfo=timezone.utc)
-                    
-                days_left = (end_date - datetime.now(timezone.utc)).days
-                status_text = "✅ Active" if days_left > 0 else "❌ Expired"
-                
-                await query.edit_message_text(
-                    f"👋 Welcome back!\n\n"
-                    f"💰 Plan: ${TOTAL_SUBSCRIPTION_PRICE:.2f} / {SUBSCRIPTION_DAYS} days\n"
-                    f"📊 Your status: {status_text}\n\n"
-                    f"Tap below to manage your subscription 👇",
-                    reply_markup=reply_markup,
-                    parse_mode='HTML'
-                )
-            else:
-                await query.edit_message_text(
-                    f"👋 Welcome!\n\n"
-                    f"💰 Plan: ${TOTAL_SUBSCRIPTION_PRICE:.2f} / {SUBSCRIPTION_DAYS} days\n"
-                    f"📊 Your status: ❌ Not active\n\n"
-                    f"Tap below to manage your subscription 👇",
-                    reply_markup=reply_markup,
-                    parse_mode='HTML'
-                )
-        return
-    
-    # Renew subscription (from reminder button)
-    if query.data == 'renew_subscription':
-        # Same flow as create_invoice
-        await query.edit_message_text(
-            "⏳ <b>Creating your renewal invoice...</b>\n\n"
-            "One moment! ⚡",
-            parse_mode='HTML'
-        )
-        
-        try:
-            invoice_data = await create_btcpay_invoice(telegram_id, TOTAL_SUBSCRIPTION_PRICE)
-            
-            if not invoice_data:
-                keyboard = [[InlineKeyboardButton("« Back", callback_data='back_to_menu')]]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                await query.edit_message_text(
-                    "❌ Unable to create invoice right now.\n"
-                    "Please try again in a few moments or contact support.",
-                    reply_markup=reply_markup
-                )
-                log_activity(telegram_id, 'renewal_invoice_failed')
-                return
-            
-            payment = save_payment(telegram_id, invoice_data)
+                pass  # Message might already be deleted
             
-            if not payment:
-                keyboard = [[InlineKeyboardButton("« Back", callback_data='back_to_menu')]]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                await query.edit_message_text(
-                    "❌ Error processing request.\n"
-                    "Please try again or contact support.",
-                    reply_markup=reply_markup
-                )
-                return
-            
-            checkout_link = invoice_data['checkoutLink']
-            qr_image = generate_qr_code(checkout_link)
-            
-            if qr_image:
-                try:
-                    await query.message.delete()
-                except:
-                    pass
-                
-                keyboard = [
-                    [InlineKeyboardButton("💳 Open in Browser", url=checkout_link)],
-                    [InlineKeyboardButton("« Back to Menu", callback_data='back_to_menu')]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                caption = (
-                    f"✅ <b>Renewal Invoice Created!</b>\n\n"
-                    f"💰 Amount: ${TOTAL_SUBSCRIPTION_PRICE:.2f}\n"
-                    f"⏱ Valid for: {MAX_INVOICE_AGE_MINUTES} minutes\n"
-                    f"⚡️ Payment: BTC or Lightning\n\n"
-                    f"📱 <b>Scan QR code above with your wallet</b>\n"
-                    f"Or click 'Open in Browser' to pay\n\n"
-                    f"Your subscription will extend automatically! 🎉\n\n"
-                    f"<i>Invoice ID: {invoice_data['id'][:8]}...</i>"
-                )
-                
-                await context.bot.send_photo(
-                    chat_id=telegram_id,
-                    photo=qr_image,
-                    caption=caption,
-                    reply_markup=reply_markup,
-                    parse_mode='HTML'
-                )
-            else:
-                keyboard = [
-                    [InlineKeyboardButton("💳 Pay Now", url=checkout_link)],
-                    [InlineKeyboardButton("« Back to Menu", callback_data='back_to_menu')]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                await query.edit_message_text(
-                    f"✅ <b>Renewal Invoice Created!</b>\n\n"
-                    f"💰 Amount: ${TOTAL_SUBSCRIPTION_PRICE:.2f}\n"
-                    f"⏱ Valid for: {MAX_INVOICE_AGE_MINUTES} minutes\n"
-                    f"⚡️ Payment: BTC or Lightning\n\n"
-                    f"Click <b>Pay Now</b> to open the payment page.\n"
-                    f"Your subscription will extend automatically! 🎉\n\n"
-                    f"<i>Invoice ID: {invoice_data['id'][:8]}...</i>",
-                    reply_markup=reply_markup,
-                    parse_mode='HTML'
-                )
+            reply_markup = InlineKeyboardMarkup([
+                [InlineKeyboardButton("💳 Open in Browser", url=checkout_link)],
+                [InlineKeyboardButton("« Back to Menu", callback_data='back_to_menu')]
+            ])
             
-            log_activity(telegram_id, 'renewal_invoice_created', {
-                'invoice_id': invoice_data['id'],
-                'amount': TOTAL_SUBSCRIPTION_PRICE
-            })
+            await send_qr_photo(
+                context.bot,
+                telegram_id,
+                qr_image,
+                caption=flow['qr_caption_tmpl'].format_map(invoice_slots),
+                reply_markup=reply_markup,
+                parse_mode='HTML'
+            )
+        else:
+            # Fallback if QR generation fails - use old method
+            reply_markup = InlineKeyboardMarkup([
+                [InlineKeyboardButton("💳 Pay Now", url=checkout_link)],
+                [InlineKeyboardButton("« Back to Menu", callback_data='back_to_menu')]
+            ])
             
-        except Exception as e:
-            logger.error(f"Error in renew_subscription: {e}", exc_info=True)
-            await query.edit_message_text(
-                "❌ An error occurred. Please try again later."
+            await edit_message(
+                query,
+                flow['link_text_tmpl'].format_map(invoice_slots),
+                reply_markup=reply_markup,
+                parse_mode='HTML'
             )
-        return
+        
+        log_activity(telegram_id, flow['created_action'], {
+            'invoice_id': invoice_data['id'],
+            'amount': TOTAL_SUBSCRIPTION_PRICE
+        })
     
-    # Create invoice
-    if query.data == 'create_invoice':
-        # Show loading immediately with encouraging message
-        await query.edit_message_text(
-            "⏳ <b>Creating your payment invoice...</b>\n\n"
-            "Hang tight! This will just take a moment! ⚡",
-            parse_mode='HTML'
+    except Exception as e:
+        logger.error(f"Error in invoice flow ({flow['created_action']}): {e}", exc_info=True)
+        await edit_message(
+            query,
+            "❌ An error occurred. Please try again later."
         )
-        
-        try:
-            invoice_data = await create_btcpay_invoice(telegram_id, TOTAL_SUBSCRIPTION_PRICE)
-            
-            if not invoice_data:
-                keyboard = [[InlineKeyboardButton("« Back", callback_data='menu_subscribe')]]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                await query.edit_message_text(
-                    "❌ Unable to create invoice right now.\n"
-                    "Please try again in a few moments or contact support.",
-                    reply_markup=reply_markup
-                )
-                log_activity(telegram_id, 'invoice_creation_failed')
-                return
-            
-            payment = save_payment(telegram_id, invoice_data)
-            
-            if not payment:
-                keyboard = [[InlineKeyboardButton("« Back", callback_data='menu_subscribe')]]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                await query.edit_message_text(
-                    "❌ Error processing request.\n"
-                    "Please try again or contact support.",
-                    reply_markup=reply_markup
-                )
-                return
-            
-            checkout_link = invoice_data['checkoutLink']
-            
-            # Generate QR code
-            qr_image = generate_qr_code(checkout_link)
-            
-            # Send QR code as photo
-            if qr_image:
-                # First, delete the loading message
-                try:
-                    await query.message.delete()
-                except:
-                    pass  # Message might already be deleted
-                
-                # Send the QR code image
-                keyboard = [
-                    [InlineKeyboardButton("💳 Open in Browser", url=checkout_link)],
-                    [InlineKeyboardButton("« Back to Menu", callback_data='back_to_menu')]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                caption = (
-                    f"✅ <b>Invoice Created!</b>\n\n"
-                    f"💰 Amount: ${TOTAL_SUBSCRIPTION_PRICE:.2f}\n"
-                    f"⏱ Valid for: {MAX_INVOICE_AGE_MINUTES} minutes\n"
-                    f"⚡️ Payment: BTC or Lightning\n\n"
-                    f"📱 <b>Scan QR code above with your wallet</b>\n"
-                    f"Or click 'Open in Browser' to pay\n\n"
-                    f"You'll receive confirmation automatically! 🎉\n\n"
-                    f"<i>Invoice ID: {invoice_data['id'][:8]}...</i>"
-                )
-                
-                await context.bot.send_photo(
-                    chat_id=telegram_id,
-                    photo=qr_image,
-                    caption=caption,
-                    reply_markup=reply_markup,
-                    parse_mode='HTML'
-                )
-            else:
-                # Fallback if QR generation fails - use old method
-                keyboard = [
-                    [InlineKeyboardButton("💳 Pay Now", url=checkout_link)],
-                    [InlineKeyboardButton("« Back to Menu", callback_data='back_to_menu')]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                await query.edit_message_text(
-                    f"✅ <b>Invoice Created!</b>\n\n"
-                    f"💰 Amount: ${TOTAL_SUBSCRIPTION_PRICE:.2f}\n"
-                    f"⏱ Valid for: {MAX_INVOICE_AGE_MINUTES} minutes\n"
-                    f"⚡️ Payment: BTC or Lightning\n\n"
-                    f"Click <b>Pay Now</b> to open the payment page.\n"
-                    f"You'll receive confirmation automatically! 🎉\n\n"
-                    f"<i>Invoice ID: {invoice_data['id'][:8]}...</i>",
-                    reply_markup=reply_markup,
-                    parse_mode='HTML'
-                )
-            
-            log_activity(telegram_id, 'invoice_created', {
-                'invoice_id': invoice_data['id'],
-                'amount': TOTAL_SUBSCRIPTION_PRICE
-            })
-            
-        except Exception as e:
-            logger.error(f"Error in button_callback: {e}", exc_info=True)
-            await query.edit_message_text(
-                "❌ An error occurred. Please try again later."
-            )
+
+
+@single_invoice_flow
+async def _renew_subscription(query, context: ContextTypes.DEFAULT_TYPE):
+    """Renew subscription (from reminder button)"""
+    await _invoice_flow(query, context, RENEW_INVOICE_FLOW)
+
+
+@single_invoice_flow
+async def _create_invoice(query, context: ContextTypes.DEFAULT_TYPE):
+    """Create invoice"""
+    await _invoice_flow(query, context, CREATE_INVOICE_FLOW)
+
+
+# callback_data -> handler, one dict lookup per click
+CALLBACK_HANDLERS = {
+    'menu_subscribe': _menu_subscribe,
+    'menu_status': _menu_status,
+    'menu_plans': _menu_static,
+    'menu_how': _menu_static,
+    'menu_support': _menu_static,
+    'back_to_menu': _back_to_menu,
+    'renew_subscription': _renew_subscription,
+    'create_invoice': _create_invoice,
+}
+
+
+async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle all button clicks - optimized for speed"""
+    query = update.callback_query
+    
+    # INSTANT acknowledgment to Telegram (makes it feel faster!)
+    await query.answer()
+    
+    handler = CALLBACK_HANDLERS.get(query.data)
+    if handler:
+        await handler(query, context)
 
 
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1019,8 +1399,35 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Error in error_handler: {e}")
 
 
-def main():
-    """Start the bot"""
+async def post_shutdown(application: Application):
+    """Release shared HTTP connections when the bot stops"""
+    await http_client.aclose()
+
+
+# The running Application and its loop, so stop_bot can reach them
+_bot_app: Optional[Application] = None
+_bot_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+async def post_init(application: Application):
+    """Remember the bot's event loop once it is running"""
+    global _bot_loop
+    _bot_loop = asyncio.get_running_loop()
+
+
+def stop_bot():
+    """Ask a running bot to stop (full PTB shutdown, post_shutdown included); thread-safe"""
+    if _bot_app is None or _bot_loop is None:
+        return
+    try:
+        _bot_loop.call_soon_threadsafe(_bot_app.stop_running)
+    except RuntimeError:
+        pass  # loop already closed: the bot has stopped
+
+
+def main(handle_signals: bool = True):
+    """Start the bot (handle_signals=False when the caller owns SIGINT/SIGTERM)"""
+    global _bot_app
     if not TELEGRAM_BOT_TOKEN:
         logger.critical("TELEGRAM_BOT_TOKEN not set!")
         return
@@ -1029,7 +1436,26 @@ def main():
         logger.critical("Missing required environment variables!")
         return
     
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    # libuv-based event loop for polling/webhook I/O when available
+    if uvloop is not None:
+        uvloop.install()
+    
+    application = Application.builder()\
+        .token(TELEGRAM_BOT_TOKEN)\
+        .request(HTTPXRequest(
+            connection_pool_size=TELEGRAM_POOL_SIZE,
+            pool_timeout=TELEGRAM_POOL_TIMEOUT,
+            http_version="2"
+        ))\
+        .get_updates_request(HTTPXRequest(pool_timeout=GET_UPDATES_POOL_TIMEOUT))\
+        .concurrent_updates(CONCURRENT_UPDATES)\
+        .rate_limiter(AIORateLimiter(overall_max_rate=TELEGRAM_MAX_RATE, overall_time_period=1))\
+        .post_init(post_init)\
+        .post_shutdown(post_shutdown)\
+        .build()
+    _bot_app = application
+    
+    load_paying_users()
     
     # Add handlers
     application.add_handler(CommandHandler("start", start))
@@ -1041,7 +1467,25 @@ def main():
     logger.info(f"Rate limiting: {'Enabled' if cache else 'Disabled (no Redis)'}")
     logger.info(f"Webhook verification: {'Enabled' if BTCPAY_WEBHOOK_SECRET else 'Disabled'}")
     
-    application.run_polling(allowed_updates=Update.ALL_TYPES, drop_pending_updates=True)
+    # stop_signals=None: PTB installs no signal handlers of its own
+    run_kwargs = {} if handle_signals else {'stop_signals': None}
+    
+    if TELEGRAM_WEBHOOK_URL:
+        # Telegram pushes updates to us: no getUpdates round-trips
+        logger.info(f"Update mode: webhook on port {TELEGRAM_WEBHOOK_PORT}")
+        application.run_webhook(
+            listen='0.0.0.0',
+            port=TELEGRAM_WEBHOOK_PORT,
+            url_path=TELEGRAM_BOT_TOKEN,
+            webhook_url=f"{TELEGRAM_WEBHOOK_URL.rstrip('/')}/{TELEGRAM_BOT_TOKEN}",
+            secret_token=TELEGRAM_WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,
+            drop_pending_updates=True,
+            **run_kwargs
+        )
+    else:
+        logger.info("Update mode: long-polling")
+        application.run_polling(allowed_updates=Update.ALL_TYPES, drop_pending_updates=True, **run_kwargs)
 
 
 if __name__ == '__main__':
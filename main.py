@@ -1,19 +1,31 @@
 import os
+import re
 import hmac
 import hashlib
 import logging
+import queue
 import threading
+import atexit
+import time
 import signal
 import sys
 from datetime import datetime, timedelta
 from typing import Optional, Dict
 from functools import wraps
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
 from flask import Flask, request, jsonify, abort
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import orjson
+from waitress import create_server
 
 # Import secured bot functions
 from bot import (
@@ -22,13 +34,21 @@ from bot import (
     create_or_extend_subscription,
     save_payment,
     log_activity,
-    sanitize_string,
     validate_telegram_id,
     validate_amount,
     verify_btcpay_webhook,
+    drain_activities,
+    stop_bot,
+    qr_executor,
+    main as bot_main,
     invalidate_subscription_cache,
+    get_cached_payment,
+    set_cached_payment,
+    invalidate_payment_cache,
+    format_end_date,
     SUPABASE_URL,
     SUPABASE_KEY,
+    REDIS_URL,
     TELEGRAM_BOT_TOKEN,
     BTCPAY_URL,
     BTCPAY_API_KEY,
@@ -38,22 +58,128 @@ from bot import (
     SUBSCRIPTION_DAYS,
     TOTAL_SUBSCRIPTION_PRICE,
     supabase,
-    cache
+    cache,
+    redis_pool
 )
 
-# Setup logging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO,
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler('webhook_secure.log')
-    ]
+# Setup logging: request threads only enqueue records; a QueueListener
+# thread does the console/file writes off the webhook path
+_webhook_log_file = RotatingFileHandler(
+    'webhook_secure.log', maxBytes=10_000_000, backupCount=5, encoding='utf-8'
 )
+_webhook_log_file.setFormatter(
+    logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+)
+
+# bot.py's basicConfig already attached its handlers to the root logger on import
+_root_logger = logging.getLogger()
+_log_handlers = _root_logger.handlers[:] or [logging.StreamHandler()]
+for _handler in _log_handlers:
+    _root_logger.removeHandler(_handler)
+
+_log_queue = queue.SimpleQueue()
+_root_logger.addHandler(QueueHandler(_log_queue))
+_root_logger.setLevel(logging.INFO)
+
+log_listener = QueueListener(_log_queue, *_log_handlers, _webhook_log_file, respect_handler_level=True)
+log_listener.start()
+
+
+def _stop_log_listener():
+    """Stop logging last: flush the final activity batch first so its errors are still written"""
+    drain_activities()
+    log_listener.stop()
+
+
+# Registered before WEBHOOK_IO_POOL's hook, so (atexit being LIFO) it runs after it
+atexit.register(_stop_log_listener)
+
 logger = logging.getLogger(__name__)
 
 # Flask app
+class OrjsonProvider(JSONProvider):
+    """Flask JSON provider backed by orjson (jsonify and request.get_json)"""
+    
+    def dumps(self, obj, **kwargs) -> str:
+        return orjson.dumps(obj).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
+
+JSON_HEADERS = {'Content-Type': 'application/json'}
+
+# Worker threads for a webhook's non-critical follow-up I/O (notifications,
+# invites): the webhook returns without waiting on them.
+# Drained at exit so SIGTERM doesn't drop queued notifications.
+WEBHOOK_IO_POOL = ThreadPoolExecutor(max_workers=16, thread_name_prefix='webhook-io')
+atexit.register(WEBHOOK_IO_POOL.shutdown, wait=True)
+
+
+def submit_follow_up(fn, *args):
+    """Run fn(*args) on WEBHOOK_IO_POOL, logging any exception it raises"""
+    def log_error(future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.error(f"Webhook follow-up {fn.__name__} failed", exc_info=future.exception())
+    
+    future = WEBHOOK_IO_POOL.submit(fn, *args)
+    future.add_done_callback(log_error)
+    return future
+
+# Outbound endpoints, fixed for the process lifetime
+TELEGRAM_SEND_URL = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
+DELIVER_INVITE_URL = f"{SUPABASE_URL}/functions/v1/deliver-invite"
+BTCPAY_HEALTH_URL = f"{BTCPAY_URL}/api/v1/health"
+SUPABASE_SERVICE_ROLE_KEY = os.getenv('SUPABASE_SERVICE_ROLE_KEY')
+
+# Process settings, read from the environment once at import
+PORT = int(os.getenv('PORT', '8080'))
+FLASK_ENV = os.getenv('FLASK_ENV', 'production')
+REQUIRED_ENV_VARS = (
+    'TELEGRAM_BOT_TOKEN',
+    'SUPABASE_URL',
+    'SUPABASE_KEY',
+    'BTCPAY_URL',
+    'BTCPAY_API_KEY',
+    'BTCPAY_STORE_ID',
+    'BTCPAY_WEBHOOK_SECRET'  # Security: Now required
+)
+
+
+def _pooled_session(headers: Dict = None, retry: Retry = None) -> requests.Session:
+    """Keep-alive session with its own connection pool and transport-level retries"""
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=32,
+        pool_maxsize=64,
+        max_retries=retry or Retry(total=3, backoff_factor=0.5, status_forcelist=[502, 503, 504])
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    if headers:
+        session.headers.update(headers)
+    return session
+
+
+# One session per upstream host so each keeps its own warm connections
+# sendMessage is retried by the transport (429 honours Retry-After); the final
+# response is returned rather than raised so callers just check .ok
+TELEGRAM_SESSION = _pooled_session(JSON_HEADERS, Retry(
+    total=3,
+    backoff_factor=1,
+    status_forcelist=[429, 500, 502, 503, 504],
+    allowed_methods=['POST'],
+    respect_retry_after_header=True,
+    raise_on_status=False
+))
+BTCPAY_SESSION = _pooled_session()
+SUPABASE_SESSION = _pooled_session({
+    **JSON_HEADERS,
+    'Authorization': f'Bearer {SUPABASE_SERVICE_ROLE_KEY}'
+} if SUPABASE_SERVICE_ROLE_KEY else JSON_HEADERS)
 
 # CORS with security
 CORS(app, resources={
@@ -61,134 +187,215 @@ CORS(app, resources={
     r"/webhook/*": {"origins": ["*"]}  # Webhooks need to accept from BTCPay
 })
 
-# Security headers
+# Security headers (identical on every response, built once)
+# Plain dict on purpose: Werkzeug's Headers.update only treats a real dict
+# as a mapping (a MappingProxyType gets iterated as key/value pairs)
+SECURITY_HEADERS = {
+    'X-Content-Type-Options': 'nosniff',
+    'X-Frame-Options': 'DENY',
+    'X-XSS-Protection': '1; mode=block',
+    'Strict-Transport-Security': 'max-age=31536000; includeSubDomains',
+    'Content-Security-Policy': "default-src 'self'"
+}
+
 @app.after_request
 def add_security_headers(response):
     """Add security headers to all responses"""
-    response.headers['X-Content-Type-Options'] = 'nosniff'
-    response.headers['X-Frame-Options'] = 'DENY'
-    response.headers['X-XSS-Protection'] = '1; mode=block'
-    response.headers['Strict-Transport-Security'] = 'max-age=31536000; includeSubDomains'
-    response.headers['Content-Security-Policy'] = "default-src 'self'"
+    response.headers.update(SECURITY_HEADERS)
     return response
 
 # Rate limiting
 # FIX: Removed exempt_routes (caused TypeError in Flask-Limiter 3.x)
+# Counters live in Redis (shared across workers) on the bot's connection pool;
+# without Redis each process keeps its own in-memory counts.
+if not redis_pool:
+    logger.warning("Rate limiter using per-process memory storage (REDIS_URL not set)")
+
 limiter = Limiter(
     key_func=get_remote_address,
     app=app,
     default_limits=["200 per hour"],
-    storage_uri=os.getenv('REDIS_URL', 'memory://')
+    storage_uri=REDIS_URL if redis_pool else 'memory://',
+    storage_options={'connection_pool': redis_pool} if redis_pool else {}
 )
 
 # Idempotency tracking (prevent duplicate webhook processing)
-processed_webhooks = set()  # In production, use Redis
 WEBHOOK_CACHE_SIZE = 1000
+WEBHOOK_CLAIM_TTL = 86400  # 24 hour expiry
+
+# In-memory fallback when Redis is unavailable: invoice_id -> claim time,
+# oldest first, so eviction and expiry are O(1) from the front
+processed_webhooks = OrderedDict()
+processed_webhooks_lock = threading.Lock()
 
-def is_webhook_processed(invoice_id: str) -> bool:
-    """Check if webhook was already processed"""
+
+def claim_webhook(invoice_id: str) -> bool:
+    """Atomically claim an invoice for processing; False if already claimed"""
     if cache:
         try:
-            key = f"webhook_processed:{invoice_id}"
-            return cache.exists(key) > 0
+            # SET NX EX: one round-trip, and concurrent retries can't both win
+            return bool(cache.set(f"webhook_processed:{invoice_id}", "1", nx=True, ex=WEBHOOK_CLAIM_TTL))
         except Exception as e:
-            logger.error(f"Cache check error: {e}")
-    return invoice_id in processed_webhooks
-
-def mark_webhook_processed(invoice_id: str):
-    """Mark webhook as processed (with expiry)"""
+            logger.error(f"Cache claim error: {e}")
+    
+    now = time.monotonic()
+    with processed_webhooks_lock:
+        # Lazily expire claims older than the Redis TTL
+        while processed_webhooks:
+            claimed_at = next(iter(processed_webhooks.values()))
+            if now - claimed_at < WEBHOOK_CLAIM_TTL:
+                break
+            processed_webhooks.popitem(last=False)
+        
+        if invoice_id in processed_webhooks:
+            return False
+        processed_webhooks[invoice_id] = now
+        if len(processed_webhooks) > WEBHOOK_CACHE_SIZE:
+            processed_webhooks.popitem(last=False)
+    return True
+
+
+def release_webhook(invoice_id: str):
+    """Drop a claim so a BTCPay retry can process the invoice again"""
     if cache:
         try:
-            key = f"webhook_processed:{invoice_id}"
-            cache.setex(key, 86400, "1")  # 24 hour expiry
-            return
+            cache.delete(f"webhook_processed:{invoice_id}")
         except Exception as e:
-            logger.error(f"Cache write error: {e}")
-    
-    # Fallback to in-memory set
-    processed_webhooks.add(invoice_id)
-    if len(processed_webhooks) > WEBHOOK_CACHE_SIZE:
-        processed_webhooks.pop()
-
-# Allowed table names for security (whitelist)
-ALLOWED_TABLES = {'users', 'subscriptions', 'payments', 'activity_logs'}
-
-# Supabase helper with proper error handling
-def supabase_query(table: str, method: str = 'GET', filters: Dict = None, data: Dict = None) -> Optional[list]:
-    """Execute Supabase query with error handling"""
-    # Security: Whitelist table names to prevent unauthorized access
-    if table not in ALLOWED_TABLES:
-        logger.error(f"Attempted access to unauthorized table: {table}")
-        return None
+            logger.error(f"Cache release error: {e}")
+    
+    with processed_webhooks_lock:
+        processed_webhooks.pop(invoice_id, None)
+
+
+# Payment helpers: the table, columns and filters are fixed at each call
+# site, so they go straight to the Supabase client
+def get_payment_by_invoice(invoice_id: str) -> Optional[Dict]:
+    """Payment row for an invoice, from Redis when possible"""
+    payment = get_cached_payment(invoice_id)
+    if payment:
+        return payment
     
     try:
-        if method == 'GET':
-            # FIX: Must call .select("*") before applying filters
-            query = supabase.table(table).select("*")
-            
-            if filters:
-                for key, value in filters.items():
-                    if key.startswith('eq_'):
-                        query = query.eq(key[3:], value)
-                    elif key.startswith('gte_'):
-                        query = query.gte(key[4:], value)
-            
-            result = query.execute()
-            return result.data
-        
-        elif method == 'POST':
-            result = supabase.table(table).insert(data).execute()
-            return result.data
-        
-        elif method == 'PATCH':
-            # FIX: Must call .update(data) first, THEN apply filters
-            query = supabase.table(table).update(data)
-            
-            if filters:
-                for key, value in filters.items():
-                    if key.startswith('eq_'):
-                        query = query.eq(key[3:], value)
-            
-            result = query.execute()
-            return result.data
-        
-        return None
+        result = supabase.table('payments').select('*').eq('btcpay_invoice_id', invoice_id).limit(1).execute()
     except Exception as e:
         logger.error(f"Supabase query error: {e}", exc_info=True)
         return None
+    if not result.data:
+        return None
+    
+    set_cached_payment(invoice_id, result.data[0])
+    return result.data[0]
+
+
+def update_payment(payment_id, invoice_id: str, data: Dict) -> Optional[list]:
+    """PATCH a payment row and drop its cached copy"""
+    try:
+        result = supabase.table('payments').update(data).eq('id', payment_id).execute().data
+    except Exception as e:
+        logger.error(f"Supabase query error: {e}", exc_info=True)
+        result = None
+    invalidate_payment_cache(invoice_id)
+    return result
+
+def mark_payment_insufficient(payment_id, invoice_id: str):
+    """Set status=insufficient_amount and log payment_insufficient in one transaction"""
+    try:
+        supabase.rpc('mark_payment_insufficient', {
+            'p_id': payment_id,
+            'p_amount_required': TOTAL_SUBSCRIPTION_PRICE
+        }).execute()
+    except Exception as e:
+        logger.error(f"Failed to mark payment insufficient (invoice: {invoice_id[:12]}...): {e}")
+    invalidate_payment_cache(invoice_id)
 
 def send_telegram_message(telegram_id: int, message: str, parse_mode: str = 'HTML'):
-    """Send message via Telegram with retry"""
+    """Send message via Telegram (retries happen in TELEGRAM_SESSION's adapter)"""
     if not validate_telegram_id(telegram_id):
         return False
     
-    max_retries = 3
-    for attempt in range(max_retries):
-        try:
-            url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
-            response = requests.post(
-                url,
-                json={
-                    'chat_id': telegram_id,
-                    'text': message,
-                    'parse_mode': parse_mode
-                },
-                timeout=10
-            )
-            
-            if response.ok:
-                return True
-            
-            logger.warning(f"Telegram API error (attempt {attempt + 1}): {response.status_code}")
-            
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Telegram request error (attempt {attempt + 1}): {e}")
-        
-        if attempt < max_retries - 1:
-            import time
-            time.sleep(2 ** attempt)  # Exponential backoff
+    try:
+        response = TELEGRAM_SESSION.post(
+            TELEGRAM_SEND_URL,
+            data=orjson.dumps({
+                'chat_id': telegram_id,
+                'text': message,
+                'parse_mode': parse_mode
+            }),
+            timeout=(3, 10)
+        )
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Telegram request error: {e}")
+        return False
     
-    return False
+    if not response.ok:
+        logger.warning(f"Telegram API error: {response.status_code}")
+    return response.ok
+
+
+def _send_confirmation(telegram_id: int, message: str):
+    """Send the payment confirmation, logging if every attempt failed"""
+    if not send_telegram_message(telegram_id, message):
+        logger.error(f"Failed to send confirmation to user {telegram_id}")
+
+
+def _deliver_invite(invoice_id: str):
+    """Send the private channel invite via the deliver-invite edge function"""
+    # Security: Require service role key (don't fallback to anon key)
+    if not SUPABASE_SERVICE_ROLE_KEY:
+        logger.warning("SUPABASE_SERVICE_ROLE_KEY not set - skipping invite delivery")
+        return
+    
+    try:
+        response = SUPABASE_SESSION.post(
+            DELIVER_INVITE_URL,
+            data=orjson.dumps({'invoiceId': invoice_id}),
+            timeout=10
+        )
+        if response.ok:
+            logger.info(f"✅ Invite sent (invoice: {invoice_id[:12]}...)")
+        else:
+            logger.warning(f"⚠️ Invite function returned {response.status_code}")
+    except Exception as e:
+        logger.error(f"Error calling deliver-invite function: {str(e)[:100]}")
+
+
+# User-facing webhook messages, filled with format_map at send time
+INSUFFICIENT_PAYMENT_TMPL = (
+    "⚠️ <b>Payment Received - Insufficient Amount</b>\n\n"
+    "💰 Amount received: <b>${amount:.2f}</b>\n"
+    "💵 Required amount: <b>${required:.2f}</b>\n"
+    "📉 Short by: <b>${difference:.2f}</b>\n\n"
+    "❌ <b>Your subscription was NOT activated.</b>\n\n"
+    "To resolve this:\n"
+    "1️⃣ Contact support for a refund\n"
+    "2️⃣ Or pay the remaining ${difference:.2f}\n\n"
+    "📧 Support: @betterpickz_support\n\n"
+    "<i>Invoice ID: {invoice_short}...</i>"
+)
+
+ACTIVATION_FAILED_TEXT = (
+    "⚠️ <b>Payment Received</b>\n\n"
+    "We received your payment but encountered an issue activating your subscription.\n"
+    "Our support team has been notified and will resolve this shortly.\n\n"
+    "Thank you for your patience!"
+)
+
+OVERPAYMENT_TMPL = "\n\n💝 <b>Overpayment:</b> ${overpayment:.2f}\nThank you for your generosity!"
+
+PAYMENT_CONFIRMED_TMPL = (
+    "✅ <b>Payment Confirmed!</b>\n\n"
+    "🎉 Your premium subscription is now active!\n\n"
+    "📅 Valid until: {end_date}\n"
+    "💰 Amount paid: ${amount:.2f}{overpayment_text}\n\n"
+    "Thank you for subscribing! Enjoy your premium access! 🚀\n\n"
+    "Use /status to check your subscription anytime."
+)
+
+# BTCPay invoice ids are short alphanumeric tokens; anything else is rejected
+INVOICE_ID_RE = re.compile(r'[A-Za-z0-9_-]{1,100}')
+
+# BTCPay events that can complete a payment
+RELEVANT_EVENTS = frozenset({'InvoiceSettled', 'InvoiceProcessing', 'InvoiceReceivedPayment'})
 
 
 # WEBHOOK ENDPOINTS
@@ -198,6 +405,10 @@ def btcpay_webhook():
     """
     Handle BTCPay payment notifications
     """
+    # One timestamp per request, shared by every column/log that needs it
+    received_at = datetime.now()
+    now_iso = received_at.isoformat()
+    
     try:
         # CRITICAL: Verify webhook signature (mandatory for security)
         if not BTCPAY_WEBHOOK_SECRET:
@@ -209,7 +420,11 @@ def btcpay_webhook():
             logger.warning(f"Invalid webhook signature from {request.remote_addr}")
             abort(401, "Invalid signature")
         
-        webhook_data = request.get_json(force=True)
+        # Parse the exact bytes that were just signature-checked
+        try:
+            webhook_data = orjson.loads(request.data)
+        except orjson.JSONDecodeError:
+            webhook_data = None
         
         # Validate required fields
         if not webhook_data or not isinstance(webhook_data, dict):
@@ -223,44 +438,48 @@ def btcpay_webhook():
             logger.error("Missing required webhook fields")
             abort(400, "Missing required fields")
         
-        # Sanitize invoice_id
-        invoice_id = sanitize_string(invoice_id, 100)
+        if not isinstance(invoice_id, str) or not INVOICE_ID_RE.fullmatch(invoice_id):
+            logger.error("Invalid invoiceId in webhook")
+            abort(400, "Invalid invoiceId")
         
-        logger.info(f"Webhook received: {event_type} for invoice {invoice_id}")
-        
-        # Only process relevant events
-        relevant_events = ['InvoiceSettled', 'InvoiceProcessing', 'InvoiceReceivedPayment']
-        if event_type not in relevant_events:
+        # Only process relevant events (checked before claiming, so an
+        # InvoiceCreated can't take the claim from the later settlement)
+        if event_type not in RELEVANT_EVENTS:
             logger.info(f"Ignoring event type: {event_type}")
             return jsonify({'status': 'ignored', 'reason': 'not_relevant'}), 200
         
-        # Idempotency check
-        if is_webhook_processed(invoice_id):
+        # Idempotency: claim the invoice atomically (one Redis round-trip),
+        # so BTCPay retries return here without any further work
+        if not claim_webhook(invoice_id):
             logger.info(f"Webhook already processed: {invoice_id}")
             return jsonify({'status': 'already_processed'}), 200
         
-        # Get payment from database
-        payments = supabase_query('payments', filters={
-            'eq_btcpay_invoice_id': invoice_id
-        })
-        
-        if not payments:
-            logger.error(f"Payment not found for invoice: {invoice_id[:12]}...")
-            abort(404, "Payment not found")
-        
-        payment = payments[0]
-        telegram_id = payment['user_id']
-        
-        # Validate telegram_id
-        if not validate_telegram_id(telegram_id):
-            logger.error(f"Invalid telegram_id in payment record")
-            abort(400, "Invalid user ID")
+        logger.info(f"Webhook received: {event_type} for invoice {invoice_id}")
         
-        # Validate amount
-        amount = payment.get('amount', 0)
-        if not validate_amount(amount):
-            logger.error(f"Invalid payment amount in payment record")
-            abort(400, "Invalid amount")
+        try:
+            # Get payment (cached when the bot created the invoice)
+            payment = get_payment_by_invoice(invoice_id)
+            
+            if not payment:
+                logger.error(f"Payment not found for invoice: {invoice_id[:12]}...")
+                abort(404, "Payment not found")
+            
+            telegram_id = payment['user_id']
+            
+            # Validate telegram_id
+            if not validate_telegram_id(telegram_id):
+                logger.error(f"Invalid telegram_id in payment record")
+                abort(400, "Invalid user ID")
+            
+            # Validate amount
+            amount = payment.get('amount', 0)
+            if not validate_amount(amount):
+                logger.error(f"Invalid payment amount in payment record")
+                abort(400, "Invalid amount")
+        except Exception:
+            # Nothing was processed yet: let a BTCPay retry try again
+            release_webhook(invoice_id)
+            raise
         
     
        # Verify amount meets subscription price
@@ -270,43 +489,22 @@ def btcpay_webhook():
                 f"User paid ${amount:.2f} but needs ${TOTAL_SUBSCRIPTION_PRICE:.2f} (invoice: {invoice_id[:12]}...)"
             )
             
-            # Mark as processed to prevent retry
-            mark_webhook_processed(invoice_id)
-            
-            # Update payment status to insufficient
-            supabase_query('payments', method='PATCH',
-                filters={'eq_id': payment['id']},
-                data={
-                    'status': 'insufficient_amount',
-                    'paid_at': datetime.now().isoformat(),
-                    'webhook_received_at': datetime.now().isoformat()
-                }
-            )
+            # Flag the payment and log the activity in one RPC
+            mark_payment_insufficient(payment['id'], invoice_id)
             
             # Notify user about insufficient payment
             difference = TOTAL_SUBSCRIPTION_PRICE - amount
-            send_telegram_message(
+            submit_follow_up(
+                send_telegram_message,
                 telegram_id,
-                f"⚠️ <b>Payment Received - Insufficient Amount</b>\n\n"
-                f"💰 Amount received: <b>${amount:.2f}</b>\n"
-                f"💵 Required amount: <b>${TOTAL_SUBSCRIPTION_PRICE:.2f}</b>\n"
-                f"📉 Short by: <b>${difference:.2f}</b>\n\n"
-                f"❌ <b>Your subscription was NOT activated.</b>\n\n"
-                f"To resolve this:\n"
-                f"1️⃣ Contact support for a refund\n"
-                f"2️⃣ Or pay the remaining ${difference:.2f}\n\n"
-                f"📧 Support: @betterpickz_support\n\n"
-                f"<i>Invoice ID: {invoice_id[:12]}...</i>"
+                INSUFFICIENT_PAYMENT_TMPL.format_map({
+                    'amount': amount,
+                    'required': TOTAL_SUBSCRIPTION_PRICE,
+                    'difference': difference,
+                    'invoice_short': invoice_id[:12]
+                })
             )
             
-            # Log the insufficient payment
-            log_activity(telegram_id, 'payment_insufficient', {
-                'invoice_id': invoice_id,
-                'amount_paid': amount,
-                'amount_required': TOTAL_SUBSCRIPTION_PRICE,
-                'difference': difference
-            })
-            
             # Return error - NO SUBSCRIPTION WILL BE CREATED
             return jsonify({
                 'status': 'error',
@@ -319,34 +517,30 @@ def btcpay_webhook():
         # Amount is sufficient - proceed with subscription activation        
         logger.info(f"✅ Payment verified: ${amount:.2f} >= ${TOTAL_SUBSCRIPTION_PRICE:.2f} (invoice: {invoice_id[:12]}...)")
         
-        # Mark webhook as processed
-        mark_webhook_processed(invoice_id)
+        # Create or extend subscription
+        subscription = create_or_extend_subscription(telegram_id, amount, invoice_id)
         
-        # Update payment status
-        update_result = supabase_query('payments', method='PATCH',
-            filters={'eq_id': payment['id']},
-            data={
-                'status': 'paid',
-                'paid_at': datetime.now().isoformat(),
-                'webhook_received_at': datetime.now().isoformat()
-            }
-        )
+        # Mark paid and link the subscription in a single PATCH
+        payment_update = {
+            'status': 'paid',
+            'paid_at': now_iso,
+            'webhook_received_at': now_iso
+        }
+        if subscription:
+            payment_update['subscription_id'] = subscription['id']
+        
+        update_result = update_payment(payment['id'], invoice_id, payment_update)
         
         if not update_result:
             logger.error(f"Failed to update payment status (invoice: {invoice_id[:12]}...)")
         
-        # Create or extend subscription
-        subscription = create_or_extend_subscription(telegram_id, amount, invoice_id)
-        
         if not subscription:
             logger.error(f"Failed to create/extend subscription (invoice: {invoice_id[:12]}...)")
             # Still send a notification to user
-            send_telegram_message(
+            submit_follow_up(
+                send_telegram_message,
                 telegram_id,
-                "⚠️ <b>Payment Received</b>\n\n"
-                "We received your payment but encountered an issue activating your subscription.\n"
-                "Our support team has been notified and will resolve this shortly.\n\n"
-                "Thank you for your patience!"
+                ACTIVATION_FAILED_TEXT
             )
             
             # Log critical error
@@ -357,83 +551,34 @@ def btcpay_webhook():
             
             return jsonify({'status': 'error', 'reason': 'subscription_failed'}), 500
         
-        # Link payment to subscription
-        try:
-            supabase_query('payments', method='PATCH',
-                filters={'eq_id': payment['id']},
-                data={'subscription_id': subscription['id']}
-            )
-            logger.info(f"Linked payment {payment['id']} to subscription {subscription['id']}")
-        except Exception as e:
-            logger.warning(f"Failed to link payment to subscription: {e}")
-        
-        # Get end date
-        end_date = datetime.fromisoformat(subscription['end_date'])
-        
         # Determine if this was an overpayment
         overpayment = amount - TOTAL_SUBSCRIPTION_PRICE
         overpayment_text = ""
         if overpayment > 0.01:  # More than 1 cent overpaid
-            overpayment_text = f"\n\n💝 <b>Overpayment:</b> ${overpayment:.2f}\nThank you for your generosity!"
+            overpayment_text = OVERPAYMENT_TMPL.format_map({'overpayment': overpayment})
         
-        # Send confirmation to user
-        success = send_telegram_message(
+        # Confirm to user and deliver the invite in the background:
+        # the subscription is active, so BTCPay gets its 200 right away
+        submit_follow_up(
+            _send_confirmation,
             telegram_id,
-            f"✅ <b>Payment Confirmed!</b>\n\n"
-            f"🎉 Your premium subscription is now active!\n\n"
-            f"📅 Valid until: {end_date.strftime('%B %d, %Y')}\n"
-            f"💰 Amount paid: ${amount:.2f}{overpayment_text}\n\n"
-            f"Thank you for subscribing! Enjoy your premium access! 🚀\n\n"
-            f"Use /status to check your subscription anytime."
+            PAYMENT_CONFIRMED_TMPL.format_map({
+                'end_date': format_end_date(subscription['end_date']),
+                'amount': amount,
+                'overpayment_text': overpayment_text
+            })
         )
-        
-        if not success:
-            logger.error(f"Failed to send confirmation to user {telegram_id}")
+        submit_follow_up(_deliver_invite, invoice_id)
         
         # Log activity
         log_activity(telegram_id, 'payment_received', {
             'invoice_id': invoice_id,
             'amount': amount,
-            'end_date': end_date.isoformat(),
+            'end_date': subscription['end_date'],
             'event_type': event_type,
             'overpayment': overpayment if overpayment > 0.01 else 0
         })
         
-        # Send private channel invite via edge function (non-blocking)
-        try:
-            edge_function_url = f"{SUPABASE_URL}/functions/v1/deliver-invite"
-            edge_function_key = os.getenv('SUPABASE_SERVICE_ROLE_KEY')
-            
-            # Security: Require service role key (don't fallback to anon key)
-            if not edge_function_key:
-                logger.warning("SUPABASE_SERVICE_ROLE_KEY not set - skipping invite delivery")
-            else:
-                # Call edge function asynchronously (don't block webhook response)
-                def send_invite_async():
-                    try:
-                        response = requests.post(
-                            edge_function_url,
-                            json={'invoiceId': invoice_id},
-                            headers={
-                                'Authorization': f'Bearer {edge_function_key}',
-                                'Content-Type': 'application/json'
-                            },
-                            timeout=10
-                        )
-                        if response.ok:
-                            logger.info(f"✅ Invite sent (invoice: {invoice_id[:12]}...)")
-                        else:
-                            logger.warning(f"⚠️ Invite function returned {response.status_code}")
-                    except Exception as e:
-                        logger.error(f"Error calling deliver-invite function: {str(e)[:100]}")
-                
-                # Run in background thread (non-blocking)
-                invite_thread = threading.Thread(target=send_invite_async, daemon=True)
-                invite_thread.start()
-            
-        except Exception as e:
-            logger.warning(f"Failed to trigger invite delivery: {str(e)[:100]}")
-        
         logger.info(f"✅ Webhook processed successfully (invoice: {invoice_id[:12]}...)")
         
         return jsonify({
@@ -445,7 +590,7 @@ def btcpay_webhook():
         
     except Exception as e:
         # Security: Log full error internally but don't expose details to client
-        error_id = f"ERR_{int(datetime.now().timestamp())}"
+        error_id = f"ERR_{int(received_at.timestamp())}"
         logger.error(f"Webhook processing error [{error_id}]: {e}", exc_info=True)
         
         # Don't expose internal errors or stack traces
@@ -456,13 +601,16 @@ def btcpay_webhook():
         }), 500
 
 
-@app.route('/health', methods=['GET'])
-@limiter.exempt  # FIX: Correct way to exempt routes in Flask-Limiter 3.x
-def health():
-    """
-    Health check endpoint
-    Returns service status and connectivity checks
-    """
+# Health probes hit Supabase and BTCPay; the result is reused for a few
+# seconds so frequent platform health checks don't each pay for both
+HEALTH_CACHE_TTL = 10
+_health_cache = (0.0, b'', 200)  # (expires_at monotonic, JSON body, status code)
+_health_lock = threading.Lock()
+SHUTTING_DOWN_BODY = orjson.dumps({'status': 'shutting_down'})
+
+
+def _probe_health() -> tuple:
+    """Run the connectivity checks, returns (JSON body, status code)"""
     health_status = {
         'status': 'ok',
         'timestamp': datetime.now().isoformat(),
@@ -481,8 +629,7 @@ def health():
     
     # Check BTCPay connectivity
     try:
-        url = f"{BTCPAY_URL}/api/v1/health"
-        response = requests.get(url, timeout=5)
+        response = BTCPAY_SESSION.get(BTCPAY_HEALTH_URL, timeout=5)
         health_status['btcpay'] = 'connected' if response.ok else 'error'
     except Exception as e:
         logger.error(f"Health check - BTCPay error: {e}")
@@ -493,14 +640,38 @@ def health():
     health_status['cache'] = 'enabled' if cache else 'disabled'
     
     status_code = 200 if health_status['status'] == 'ok' else 503
-    return jsonify(health_status), status_code
+    return orjson.dumps(health_status), status_code
+
+
+@app.route('/health', methods=['GET'])
+@limiter.exempt  # FIX: Correct way to exempt routes in Flask-Limiter 3.x
+def health():
+    """
+    Health check endpoint
+    Returns service status and connectivity checks (cached for HEALTH_CACHE_TTL)
+    """
+    global _health_cache
+    
+    # Draining: tell the load balancer to stop routing here
+    if shutdown_event.is_set():
+        return app.response_class(SHUTTING_DOWN_BODY, status=503, mimetype='application/json')
+    
+    # One thread probes at a time; concurrent checks reuse its result
+    with _health_lock:
+        expires_at, body, status_code = _health_cache
+        now = time.monotonic()
+        if now >= expires_at:
+            body, status_code = _probe_health()
+            _health_cache = (now + HEALTH_CACHE_TTL, body, status_code)
+    
+    return app.response_class(body, status=status_code, mimetype='application/json')
 
 
 @app.route('/webhook/test', methods=['POST'])
 @limiter.limit("10 per minute")
 def webhook_test():
     """Test endpoint for webhook verification (development only)"""
-    if os.getenv('FLASK_ENV') != 'development':
+    if FLASK_ENV != 'development':
         abort(404)
     
     return jsonify({
@@ -545,58 +716,144 @@ def internal_error(e):
 
 
 # APPLICATION LIFECYCLE
-bot_thread = None
-flask_running = False
+flask_ready = threading.Event()  # set once the webhook socket is listening
+shutdown_event = threading.Event()  # set once shutdown begins (/health turns 503)
+webhook_server = None  # waitress server, closed on shutdown
+
+# Shutdown signals; on POSIX they are taken synchronously by a sigwait thread
+SHUTDOWN_SIGNALS = {signal.SIGINT, signal.SIGTERM}
+
+# Upper bound on flushing queued notifications/activity rows at shutdown
+SHUTDOWN_DRAIN_TIMEOUT = 10
+
+# After a signal, force the exit if the bot hasn't stopped by then
+SHUTDOWN_GRACE = 30
+
+# Startup banner: everything in it is fixed at import, so build it once
+STARTUP_BANNER = "\n".join((
+    "=" * 60,
+    "🚀 Starting Secured Telegram Subscription Bot v2.1",
+    "=" * 60,
+    f"Environment: {FLASK_ENV}",
+    f"Subscription: ${SUBSCRIPTION_PRICE} + fee = ${TOTAL_SUBSCRIPTION_PRICE} for {SUBSCRIPTION_DAYS} days",
+    "Security features:",
+    "  - Amount verification: ✅ ENABLED (STRICT)",
+    "  - Webhook verification: ✅ ENABLED (REQUIRED)",
+    f"  - Rate limiting: {'✅ Enabled' if cache else '⚠️  Fallback mode'}",
+    "  - Input validation: ✅ Enabled",
+    "  - Idempotency: ✅ Enabled",
+    "  - CORS protection: ✅ Enabled",
+    "  - Security headers: ✅ Enabled",
+    "=" * 60
+))
+
+# Waitress tuning: enough worker threads that a burst of webhooks doesn't
+# queue behind slow Supabase calls (upstream I/O is offloaded or pooled);
+# idle keep-alive connections from BTCPay are kept for WEB_CHANNEL_TIMEOUT
+WEB_THREADS = int(os.getenv('WEB_THREADS', max(16, (os.cpu_count() or 1) * 2)))
+WEB_CONNECTION_LIMIT = int(os.getenv('WEB_CONNECTION_LIMIT', '200'))
+WEB_CHANNEL_TIMEOUT = int(os.getenv('WEB_CHANNEL_TIMEOUT', '30'))
+
 
 def run_flask():
     """Run Flask server"""
-    global flask_running
-    port = int(os.getenv('PORT', 8080))
-    
-    logger.info(f"Starting Flask webhook server on port {port}")
-    flask_running = True
+    global webhook_server
+    logger.info(f"Starting webhook server on port {PORT} (waitress, {WEB_THREADS} threads)")
     
-    # In production, use a proper WSGI server
-    if os.getenv('FLASK_ENV') == 'production':
-        from waitress import serve
-        serve(app, host='0.0.0.0', port=port, threads=4)
-    else:
-        app.run(host='0.0.0.0', port=port, debug=False)
-
-
-def run_bot():
+    # create_server binds and listens before returning
+    webhook_server = create_server(
+        app,
+        host='0.0.0.0',
+        port=PORT,
+        threads=WEB_THREADS,
+        connection_limit=WEB_CONNECTION_LIMIT,
+        channel_timeout=WEB_CHANNEL_TIMEOUT,
+        asyncore_use_poll=True
+    )
+    flask_ready.set()
+    webhook_server.run()
+
+
+def run_bot(handle_signals: bool = True):
     """Run Telegram bot"""
-    from bot import main as bot_main
     logger.info("Starting Telegram bot")
-    bot_main()
+    bot_main(handle_signals=handle_signals)
+
 
+def _stop_webhook_server():
+    """Stop accepting webhooks; BTCPay retries anything refused from here on"""
+    shutdown_event.set()
+    if webhook_server is not None:
+        webhook_server.close()
 
-def signal_handler(signum, frame):
-    """Handle shutdown signals gracefully"""
-    global flask_running
+
+def _drain_background_work():
+    """Finish queued webhook follow-ups and activity rows, stop QR workers"""
+    WEBHOOK_IO_POOL.shutdown(wait=True)
+    drain_activities()
+    qr_executor.shutdown(wait=True, cancel_futures=True)
+
+
+def _shutdown():
+    """Clean up after the bot has stopped (bounded drain)"""
+    if not shutdown_event.is_set():
+        _stop_webhook_server()
+    
+    drainer = threading.Thread(target=_drain_background_work, daemon=True, name="ShutdownDrain")
+    drainer.start()
+    drainer.join(SHUTDOWN_DRAIN_TIMEOUT)
+    if drainer.is_alive():
+        # atexit would block on the same pools again
+        logger.warning(f"Shutdown drain exceeded {SHUTDOWN_DRAIN_TIMEOUT}s - exiting anyway")
+        log_listener.stop()
+        os._exit(1)
+
+
+def _sigwait_loop():
+    """Wait for SIGINT/SIGTERM, then stop the webhook server and the bot"""
+    signum = signal.sigwait(SHUTDOWN_SIGNALS)
     logger.info(f"Received signal {signum}, shutting down gracefully...")
-    flask_running = False
-    sys.exit(0)
+    _stop_webhook_server()
+    
+    # run_bot() returns in the main thread once the Application has shut
+    # down, and main() finishes the cleanup from there
+    stop_bot()
+    
+    time.sleep(SHUTDOWN_GRACE)
+    logger.critical(f"Bot did not stop within {SHUTDOWN_GRACE}s - forcing exit")
+    log_listener.stop()
+    os._exit(1)
+
+
+def _install_signal_waiter() -> bool:
+    """Route SIGINT/SIGTERM to a sigwait thread, False where unsupported (Windows)"""
+    if not (hasattr(signal, 'pthread_sigmask') and hasattr(signal, 'sigwait')):
+        return False
+    
+    # Threads started from here on (webhook server, bot, pools) inherit the
+    # mask, so no handler can interrupt one of them mid-log
+    signal.pthread_sigmask(signal.SIG_BLOCK, SHUTDOWN_SIGNALS)
+    waiter = threading.Thread(target=_sigwait_loop, daemon=True, name="SignalWaiter")
+    waiter.start()
+    
+    # Threads started at import (log listener, activity flusher, Redis
+    # pub/sub) don't block the signals; if one of them receives it, this
+    # handler re-targets it at the waiter
+    def forward_to_waiter(signum, frame):
+        signal.pthread_kill(waiter.ident, signum)
+    
+    for signum in SHUTDOWN_SIGNALS:
+        signal.signal(signum, forward_to_waiter)
+    return True
 
 
 def main():
     """Main entry point"""
-    # Register signal handlers
-    signal.signal(signal.SIGTERM, signal_handler)
-    signal.signal(signal.SIGINT, signal_handler)
+    # Without the waiter (Windows), PTB's own handling / KeyboardInterrupt stop the bot
+    signal_waiter = _install_signal_waiter()
     
     # Validate environment
-    required_vars = [
-        'TELEGRAM_BOT_TOKEN',
-        'SUPABASE_URL',
-        'SUPABASE_KEY',
-        'BTCPAY_URL',
-        'BTCPAY_API_KEY',
-        'BTCPAY_STORE_ID',
-        'BTCPAY_WEBHOOK_SECRET'  # Security: Now required
-    ]
-    
-    missing_vars = [var for var in required_vars if not os.getenv(var)]
+    missing_vars = [var for var in REQUIRED_ENV_VARS if not os.environ.get(var)]
     if missing_vars:
         logger.critical(f"Missing required environment variables: {', '.join(missing_vars)}")
         logger.critical("⚠️  BTCPAY_WEBHOOK_SECRET is now REQUIRED for security!")
@@ -605,42 +862,30 @@ def main():
     if not cache:
         logger.warning("⚠️  Redis not configured - rate limiting and caching will use fallbacks")
     
-    logger.info("=" * 60)
-    logger.info("🚀 Starting Secured Telegram Subscription Bot v2.1")
-    logger.info("=" * 60)
-    logger.info(f"Environment: {os.getenv('FLASK_ENV', 'production')}")
-    logger.info(f"Subscription: ${SUBSCRIPTION_PRICE} + fee = ${TOTAL_SUBSCRIPTION_PRICE} for {SUBSCRIPTION_DAYS} days")
-    logger.info(f"Security features:")
-    logger.info(f"  - Amount verification: ✅ ENABLED (STRICT)")
-    logger.info(f"  - Webhook verification: ✅ ENABLED (REQUIRED)")
-    logger.info(f"  - Rate limiting: {'✅ Enabled' if cache else '⚠️  Fallback mode'}")
-    logger.info(f"  - Input validation: ✅ Enabled")
-    logger.info(f"  - Idempotency: ✅ Enabled")
-    logger.info(f"  - CORS protection: ✅ Enabled")
-    logger.info(f"  - Security headers: ✅ Enabled")
-    logger.info("=" * 60)
+    logger.info(STARTUP_BANNER)
     
     try:
         # Start Flask in a separate thread
-        global bot_thread
-        flask_thread = threading.Thread(target=run_flask, daemon=False, name="FlaskWebhook")
+        flask_thread = threading.Thread(target=run_flask, daemon=True, name="FlaskWebhook")
         flask_thread.start()
         
-        # Give Flask time to start
-        import time
-        time.sleep(2)
+        if not flask_ready.wait(timeout=10):
+            logger.critical("Webhook server failed to start within 10s")
+            sys.exit(1)
         
         logger.info("✅ Flask webhook server started")
         logger.info("✅ Starting Telegram bot...")
         
         # Run bot in main thread
-        run_bot()
+        run_bot(handle_signals=not signal_waiter)
         
     except KeyboardInterrupt:
         logger.info("Shutting down...")
     except Exception as e:
         logger.critical(f"Fatal error: {e}", exc_info=True)
         sys.exit(1)
+    
+    _shutdown()
 
 
 if __name__ == '__main__':
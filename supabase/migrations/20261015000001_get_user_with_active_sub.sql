@@ -0,0 +1,37 @@
+-- Upsert a user and fetch their newest active subscription in one round-trip.
+-- Called from bot.py (get_user_with_active_subscription) on /start.
+
+create unique index if not exists users_telegram_id_key
+    on public.users (telegram_id);
+
+create or replace function public.get_user_with_active_sub(
+    p_tid bigint,
+    p_username text default null,
+    p_first text default null
+)
+returns json
+language sql
+as $$
+    with upserted as (
+        insert into public.users as u (telegram_id, username, first_name, created_at)
+        values (p_tid, p_username, p_first, now())
+        on conflict (telegram_id) do update
+            set username = coalesce(excluded.username, u.username),
+                first_name = coalesce(excluded.first_name, u.first_name)
+        returning u.*
+    )
+    select json_build_object(
+        'user', row_to_json(upserted),
+        'subscription', row_to_json(sub)
+    )
+    from upserted
+    left join lateral (
+        select s.*
+        from public.subscriptions s
+        where s.user_id = p_tid
+          and s.status = 'active'
+          and s.end_date >= now()
+        order by s.end_date desc
+        limit 1
+    ) sub on true;
+$$;
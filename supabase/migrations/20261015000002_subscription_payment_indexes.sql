@@ -0,0 +1,16 @@
+-- Indexes for the hot lookups in bot.py / main.py.
+-- Plain CREATE INDEX: migrations run inside a transaction, which rules out CONCURRENTLY.
+-- On a large live table, run the CONCURRENTLY variant by hand first.
+
+-- get_active_subscription / create_or_extend_subscription
+create index if not exists idx_subs_active
+    on public.subscriptions (user_id, end_date desc)
+    where status = 'active';
+
+-- Payment history per user
+create index if not exists idx_payments_user_created
+    on public.payments (user_id, created_at desc);
+
+-- Webhook lookup by BTCPay invoice id
+create index if not exists idx_payments_invoice
+    on public.payments (btcpay_invoice_id);
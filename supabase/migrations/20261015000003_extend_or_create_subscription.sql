@@ -0,0 +1,37 @@
+-- Atomic create-or-extend for subscriptions (replaces SELECT + UPDATE/INSERT).
+-- Called from bot.py (create_or_extend_subscription) on payment settlement.
+
+-- The upsert needs at most one active row per user. Rows left behind by the
+-- old read-then-insert race are superseded, keeping the newest end_date.
+update public.subscriptions s
+set status = 'superseded'
+where s.status = 'active'
+  and exists (
+      select 1
+      from public.subscriptions newer
+      where newer.user_id = s.user_id
+        and newer.status = 'active'
+        and (newer.end_date, newer.id) > (s.end_date, s.id)
+  );
+
+create unique index if not exists subscriptions_one_active_per_user
+    on public.subscriptions (user_id)
+    where status = 'active';
+
+create or replace function public.extend_or_create_subscription(
+    p_user_id bigint,
+    p_amount numeric,
+    p_days integer
+)
+returns setof public.subscriptions
+language sql
+as $$
+    insert into public.subscriptions as s
+        (user_id, status, plan_type, amount_paid, start_date, end_date, created_at)
+    values
+        (p_user_id, 'active', 'monthly', p_amount, now(), now() + make_interval(days => p_days), now())
+    on conflict (user_id) where status = 'active' do update
+        set end_date = greatest(s.end_date, now()) + make_interval(days => p_days),
+            updated_at = now()
+    returning s.*;
+$$;
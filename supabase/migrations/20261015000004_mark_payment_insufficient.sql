@@ -0,0 +1,33 @@
+-- Record an underpaid invoice in one round-trip: flag the payment row and
+-- write the activity log entry in the same transaction.
+-- Called from main.py (mark_payment_insufficient) on the insufficient-amount branch.
+
+create or replace function public.mark_payment_insufficient(
+    p_id bigint,
+    p_amount_required numeric
+)
+returns setof public.payments
+language sql
+as $$
+    with updated as (
+        update public.payments p
+        set status = 'insufficient_amount',
+            paid_at = now(),
+            webhook_received_at = now()
+        where p.id = p_id
+        returning p.*
+    ), logged as (
+        insert into public.activity_logs (user_id, action, details, created_at)
+        select u.user_id,
+               'payment_insufficient',
+               jsonb_build_object(
+                   'invoice_id', u.btcpay_invoice_id,
+                   'amount_paid', u.amount,
+                   'amount_required', p_amount_required,
+                   'difference', p_amount_required - u.amount
+               ),
+               now()
+        from updated u
+    )
+    select * from updated;
+$$;
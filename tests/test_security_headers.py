@@ -0,0 +1,35 @@
+import os
+
+import pytest
+
+pytest.importorskip("flask")
+pytest.importorskip("telegram")
+
+# bot.py refuses to import without pricing configured
+os.environ.setdefault("SUBSCRIPTION_PRICE", "10")
+os.environ.setdefault("PROCESSING_FEE_PERCENT", "5")
+
+import main  # noqa: E402
+
+
+@pytest.fixture
+def client(monkeypatch):
+    # Keep /health off the network: the headers don't depend on the probe
+    monkeypatch.setattr(main, "_probe_health", lambda: (b'{"status": "ok"}', 200))
+    monkeypatch.setattr(main, "_health_cache", (0.0, b"", 200))
+    main.app.config["TESTING"] = True
+    return main.app.test_client()
+
+
+def test_health_has_security_headers(client):
+    response = client.get("/health")
+    assert response.status_code == 200
+    for name, value in main.SECURITY_HEADERS.items():
+        assert response.headers[name] == value
+
+
+def test_error_responses_have_security_headers(client):
+    response = client.get("/no-such-route")
+    assert response.status_code == 404
+    for name, value in main.SECURITY_HEADERS.items():
+        assert response.headers[name] == value